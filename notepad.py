@@ -12,21 +12,41 @@ Sample notepad GUI.
 """
 
 
+import os
+import re
 import sys
 
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QStatusBar, QAction,
-                             QTextEdit, QToolBar, QDockWidget)
+                             QTextEdit, QToolBar, QDockWidget, QFileDialog,
+                             QMessageBox, QProgressBar, QPushButton,
+                             QInputDialog, QStackedWidget)
 from PyQt5.QtCore import Qt, QSize
-from PyQt5.QtGui import QIcon
+from PyQt5.QtGui import QIcon, QTextCursor
+
+from textfile import FileLoader, LargeFileView
 
 
 class Window(QMainWindow):
+    # Files this big open in the paged, read-only large-file view.
+    LARGE_FILE_SIZE = 64 << 20
+
     def __init__(self):
         super(Window, self).__init__()
         self.setGeometry(100, 100, 350, 350)
         self.setWindowTitle('Notepad')
-        self.setCentralWidget(QTextEdit())
+        self.loader = None
+        self.open_cursor = None
+        self.find_text = None
+        self.textedit = QTextEdit()
+        self.viewer = LargeFileView()
+        self.viewer.indexed.connect(self.on_indexed)
+        self.viewer.found.connect(self.on_large_found)
+        self.stack = QStackedWidget()
+        self.stack.addWidget(self.textedit)
+        self.stack.addWidget(self.viewer)
+        self.setCentralWidget(self.stack)
         self.add_menubar()
+        self.add_statusbar()
         self.add_toolbar()
         self.add_dock()
         self.show()
@@ -35,8 +55,16 @@ class Window(QMainWindow):
         # Add menubar and menus.
         menubar = self.menuBar()
         file_menu = menubar.addMenu('File')
+        edit_menu = menubar.addMenu('Edit')
         view_menu = menubar.addMenu('View')
 
+        # Add Open action to File menu.
+        open_action = QAction(QIcon('resources/open_file.png'), 'Open', self)
+        open_action.setShortcut('Ctrl+O')
+        open_action.setStatusTip('Open a text file')
+        open_action.triggered.connect(self.on_open)
+        file_menu.addAction(open_action)
+
         # Add Exit action to File menu.
         exit_action = QAction(QIcon('resources/exit.png'), 'Exit', self)
         exit_action.setShortcut('Ctrl+Q')
@@ -44,6 +72,27 @@ class Window(QMainWindow):
         exit_action.triggered.connect(self.close)
         file_menu.addAction(exit_action)
 
+        # Add Find action to Edit menu.
+        find_action = QAction('Find', self)
+        find_action.setShortcut('Ctrl+F')
+        find_action.setStatusTip('Find text')
+        find_action.triggered.connect(self.on_find)
+        edit_menu.addAction(find_action)
+
+        # Add Find Next action to Edit menu.
+        find_next_action = QAction('Find Next', self)
+        find_next_action.setShortcut('F3')
+        find_next_action.setStatusTip('Find the next match')
+        find_next_action.triggered.connect(self.on_find_next)
+        edit_menu.addAction(find_next_action)
+
+        # Add Go to Line action to Edit menu.
+        goto_action = QAction('Go to Line', self)
+        goto_action.setShortcut('Ctrl+G')
+        goto_action.setStatusTip('Jump to a line number')
+        goto_action.triggered.connect(self.on_goto_line)
+        edit_menu.addAction(goto_action)
+
         # Add Fullscreen action to View menu.
         appearance_submenu = view_menu.addMenu('Appearance')
         fullscreen_action = QAction('Fullscreen', self, checkable=True)
@@ -51,9 +100,173 @@ class Window(QMainWindow):
         fullscreen_action.triggered.connect(self.on_fullscreen)
         appearance_submenu.addAction(fullscreen_action)
 
-        # Add statusbar.
+    def add_statusbar(self):
         self.setStatusBar(QStatusBar(self))
 
+        # Add progress bar and Cancel button for opening files.
+        self.progress_bar = QProgressBar()
+        self.progress_bar.setFixedWidth(120)
+        self.progress_bar.setRange(0, 100)
+        self.progress_bar.setVisible(False)
+        self.statusBar().addPermanentWidget(self.progress_bar)
+
+        self.cancel_button = QPushButton('Cancel')
+        self.cancel_button.clicked.connect(self.on_cancel)
+        self.cancel_button.setVisible(False)
+        self.statusBar().addPermanentWidget(self.cancel_button)
+
+    def on_open(self):
+        fname, _ = QFileDialog.getOpenFileName(
+            self, 'Open File', './resources', 'Text Files (*.txt)')
+        if fname:
+            self.open_file(fname)
+
+    def open_file(self, fname):
+        """Loads fname as plain text in chunks; the window stays live."""
+        if self.loader is not None:
+            self.loader.cancel()
+            self.finish_open()
+
+        try:
+            large = os.path.getsize(fname) >= self.LARGE_FILE_SIZE
+        except OSError:
+            large = False  # The loader reports it.
+        if large:
+            self.open_large(fname)
+            return
+
+        self.viewer.close_file()
+        self.stack.setCurrentWidget(self.textedit)
+        self.textedit.clear()
+        self.textedit.setReadOnly(True)
+        # Undo would keep a second copy of the whole file.
+        self.textedit.document().setUndoRedoEnabled(False)
+        self.open_cursor = QTextCursor(self.textedit.document())
+
+        self.loader = FileLoader(fname, self)
+        self.loader.chunk.connect(self.on_open_chunk)
+        self.loader.finished.connect(self.on_opened)
+        self.loader.error.connect(self.on_open_error)
+        self.statusBar().showMessage(f'Opening {fname}...')
+        self.progress_bar.setValue(0)
+        self.progress_bar.setVisible(True)
+        self.cancel_button.setVisible(True)
+        self.loader.start()
+
+    def open_large(self, fname):
+        """Maps fname into the large-file view instead of loading it."""
+        try:
+            self.viewer.open(fname)
+        except (OSError, ValueError) as e:
+            QMessageBox.warning(self, 'Warning', str(e), QMessageBox.Ok)
+            return
+
+        self.textedit.clear()
+        self.stack.setCurrentWidget(self.viewer)
+        self.statusBar().showMessage(f'Indexing {fname}...')
+        self.progress_bar.setValue(0)
+        self.progress_bar.setVisible(True)
+
+    def on_indexed(self, progress):
+        self.progress_bar.setValue(round(progress * 100))
+        if progress >= 1:
+            self.progress_bar.setVisible(False)
+            self.statusBar().showMessage(
+                f'{self.viewer.line_count()} lines', 5000)
+
+    def is_large(self):
+        return self.stack.currentWidget() is self.viewer
+
+    def on_find(self):
+        text, ok = QInputDialog.getText(
+            self, 'Find', 'Find:', text=self.find_text or '')
+        if not ok or not text:
+            return
+        self.find_text = text
+        if self.is_large():
+            self.viewer.find(re.compile(re.escape(text.encode('utf-8'))))
+            self.statusBar().showMessage('Searching...')
+        else:
+            self.textedit.moveCursor(QTextCursor.Start)
+            self.on_find_next()
+
+    def on_find_next(self):
+        if self.find_text is None:
+            self.on_find()
+        elif self.is_large():
+            self.viewer.find_next()
+            self.statusBar().showMessage('Searching...')
+        elif not self.textedit.find(self.find_text):
+            # Wrap around to the top.
+            self.textedit.moveCursor(QTextCursor.Start)
+            if not self.textedit.find(self.find_text):
+                self.statusBar().showMessage('0 matches')
+
+    def on_large_found(self, line):
+        if line < 0:
+            self.statusBar().showMessage('0 matches')
+        else:
+            self.statusBar().showMessage(f'Match on line {line + 1}')
+
+    def on_goto_line(self):
+        if self.is_large():
+            count = self.viewer.line_count()
+        else:
+            count = self.textedit.document().blockCount()
+        line, ok = QInputDialog.getInt(
+            self, 'Go to Line', 'Line:', 1, 1, max(1, count))
+        if not ok:
+            return
+
+        if self.is_large():
+            self.viewer.goto_line(line - 1)
+        else:
+            block = self.textedit.document().findBlockByNumber(line - 1)
+            self.textedit.setTextCursor(QTextCursor(block))
+            self.textedit.ensureCursorVisible()
+
+    def on_open_chunk(self, text, progress):
+        # Drop chunks still queued from a cancelled load.
+        if self.sender() is not self.loader:
+            return
+        self.open_cursor.insertText(text)
+        self.progress_bar.setValue(round(progress * 100))
+        self.loader.next()
+
+    def on_opened(self):
+        if self.sender() is not self.loader:
+            return
+        self.finish_open()
+        self.statusBar().showMessage('Opened', 5000)
+
+    def on_open_error(self, message):
+        if self.sender() is not self.loader:
+            return
+        self.finish_open()
+        QMessageBox.warning(self, 'Warning', message, QMessageBox.Ok)
+
+    def on_cancel(self):
+        if self.loader is not None:
+            self.loader.cancel()
+            self.finish_open()
+            self.statusBar().showMessage('Cancelled', 5000)
+
+    def finish_open(self):
+        self.loader.deleteLater()
+        self.loader = None
+        self.open_cursor = None
+        self.textedit.document().setUndoRedoEnabled(True)
+        self.textedit.setReadOnly(False)
+        self.progress_bar.setVisible(False)
+        self.cancel_button.setVisible(False)
+
+    def closeEvent(self, event):
+        # The reader blocks until the next chunk is asked for; release it.
+        if self.loader is not None:
+            self.loader.cancel()
+        self.viewer.close_file()
+        super(Window, self).closeEvent(event)
+
     def on_fullscreen(self, checked):
         if checked:
             self.showFullScreen()
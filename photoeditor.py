@@ -12,15 +12,34 @@ Sample photo editor GUI.
 """
 
 
+import argparse
+import ctypes
+import glob
+import hashlib
+import itertools
+import math
+import mmap
+import multiprocessing
 import os
 import sys
+import tempfile
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
 from PyQt5.QtWidgets import (
     QApplication, QMainWindow, QWidget, QMenu, QAction, QToolBar, QDockWidget,
-    QStatusBar, QVBoxLayout, QLabel, QPushButton, QSizePolicy, QFileDialog,
-    QMessageBox)
-from PyQt5.QtCore import pyqtSlot, Qt, QSize
-from PyQt5.QtGui import QIcon, QPixmap, QTransform
+    QStatusBar, QVBoxLayout, QPushButton, QSizePolicy, QFileDialog,
+    QMessageBox, QProgressBar, QDialog, QDialogButtonBox, QFormLayout,
+    QSpinBox, QCheckBox, QListWidget, QListWidgetItem, QListView)
+from PyQt5.QtCore import (
+    pyqtSignal, pyqtSlot, Qt, QSize, QRectF, QPointF, QPoint, QObject,
+    QRunnable, QThreadPool, QTimer, QUrl)
+from PyQt5.QtGui import (
+    QIcon, QImage, QImageReader, QImageWriter, QPixmap, QPainter, QTransform)
+
+from textfile import keep_mode
 
 
 class MainWindow(QMainWindow):
@@ -33,7 +52,12 @@ class MainWindow(QMainWindow):
         self.add_toolbar()
         self.add_central_widget()
         self.add_dock()
-        self.setStatusBar(QStatusBar())
+        self.add_browser()
+        self.add_statusbar()
+        self.jobs = JobRunner()
+        self.jobs.started.connect(self.on_job_started)
+        self.jobs.progress.connect(self.progress_bar.setValue)
+        self.jobs.idle.connect(self.on_jobs_idle)
         self.show()
 
     def create_actions(self):
@@ -43,6 +67,12 @@ class MainWindow(QMainWindow):
         open_action.setStatusTip('Open image')
         open_action.triggered.connect(self.on_open)
 
+        # Create Open Folder action.
+        open_folder_action = QAction('Open Folder...', self)
+        open_folder_action.setShortcut('Ctrl+Shift+O')
+        open_folder_action.setStatusTip('Browse the images in a folder')
+        open_folder_action.triggered.connect(self.on_open_folder)
+
         # Create Save action.
         save_action = QAction(QIcon(abspath('resources/save_file.png')), 'Save', self)
         save_action.setShortcut('Ctrl+S')
@@ -90,6 +120,20 @@ class MainWindow(QMainWindow):
         resize_action.triggered.connect(self.on_resize)
         resize_action.setEnabled(False)
 
+        # Create Undo action.
+        undo_action = QAction(QIcon(abspath('resources/undo.png')), 'Undo', self)
+        undo_action.setShortcut('Ctrl+Z')
+        undo_action.setStatusTip('Undo last edit')
+        undo_action.triggered.connect(self.on_undo)
+        undo_action.setEnabled(False)
+
+        # Create Redo action.
+        redo_action = QAction(QIcon(abspath('resources/redo.png')), 'Redo', self)
+        redo_action.setShortcut('Ctrl+Shift+Z')
+        redo_action.setStatusTip('Redo last undone edit')
+        redo_action.triggered.connect(self.on_redo)
+        redo_action.setEnabled(False)
+
         # Create Clear action.
         clear_action = QAction(QIcon(abspath('resources/clear.png')), 'Clear', self)
         clear_action.setShortcut('Ctrl+D')
@@ -104,6 +148,7 @@ class MainWindow(QMainWindow):
 
         # Set actions as attributes.
         self.open_action = open_action
+        self.open_folder_action = open_folder_action
         self.save_action = save_action
         self.print_action = print_action
         self.exit_action = exit_action
@@ -112,6 +157,8 @@ class MainWindow(QMainWindow):
         self.vflip_action = vflip_action
         self.hflip_action = hflip_action
         self.resize_action = resize_action
+        self.undo_action = undo_action
+        self.redo_action = redo_action
         self.clear_action = clear_action
         self.toggle_dock_action = toggle_dock_action
 
@@ -126,6 +173,7 @@ class MainWindow(QMainWindow):
 
         # Add actions to File menu.
         file_menu.addAction(self.open_action)
+        file_menu.addAction(self.open_folder_action)
         file_menu.addAction(self.save_action)
         file_menu.addAction(self.print_action)
         file_menu.addAction(self.clear_action)
@@ -133,6 +181,9 @@ class MainWindow(QMainWindow):
         file_menu.addAction(self.exit_action)
 
         # Add actions to Edit menu.
+        edit_menu.addAction(self.undo_action)
+        edit_menu.addAction(self.redo_action)
+        edit_menu.addSeparator()
         edit_menu.addAction(self.rotate_90_action)
         edit_menu.addAction(self.rotate_180_action)
         edit_menu.addSeparator()
@@ -145,6 +196,7 @@ class MainWindow(QMainWindow):
 
         # Add actions to View menu.
         view_menu.addAction(self.toggle_dock_action)
+        self.view_menu = view_menu
 
     def add_toolbar(self):
         # Add toolbar.
@@ -157,15 +209,45 @@ class MainWindow(QMainWindow):
         toolbar.addAction(self.save_action)
         toolbar.addAction(self.print_action)
         toolbar.addAction(self.clear_action)
+        toolbar.addAction(self.undo_action)
+        toolbar.addAction(self.redo_action)
         toolbar.addAction(self.exit_action)
 
     def add_central_widget(self):
-        self.image = QPixmap()
-        self.image_label = QLabel()
-        self.image_label.setAlignment(Qt.AlignCenter)
-        self.image_label.setSizePolicy(
+        self.image = QImage()
+        # Shown again if an open is dropped while its preview is up.
+        self.previewing = False
+        self.previous_pyramid = None
+        self.edits = TransformStack()
+        self.history = EditHistory()
+        self.save_options = SaveOptions()
+        self.tile_cache = PixmapCache()
+        self.preview_cache = PixmapCache(max_bytes=32 * 1024 * 1024)
+        self.image_view = ImageView(self.preview_cache)
+        self.image_view.setSizePolicy(
             QSizePolicy.Expanding, QSizePolicy.Ignored)
-        self.setCentralWidget(self.image_label)
+        self.setCentralWidget(self.image_view)
+
+    def set_image(self, image, pyramid=None):
+        """Replaces the edited image and rebuilds its display pyramid."""
+        if pyramid is None:
+            pyramid = ImagePyramid(image, self.tile_cache)
+        self.image = image
+        self.reset_edits()
+        self.image_view.set_pyramid(pyramid)
+        self.update_view()
+
+    def reset_edits(self):
+        self.history.reset()
+        self.edits = self.history.state()
+
+    def update_view(self):
+        """Previews the pending edits and shows the resulting image size."""
+        self.image_view.set_transform(self.edits.matrix)
+        if not self.image.isNull():
+            size = self.edits.output_size(self.image.size())
+            self.statusBar().showMessage(
+                f'{size.width()} x {size.height()} px')
 
     def add_dock(self):
         # Create dock.
@@ -198,14 +280,14 @@ class MainWindow(QMainWindow):
 
         # Add Vertical Flip button.
         self.vflip_button = QPushButton('Flip Vertical')
-        self.vflip_button.setStatusTip('Flip image across vertical axis')
+        self.vflip_button.setStatusTip('Flip image upside down')
         self.vflip_button.clicked.connect(self.on_vflip)
         self.vflip_button.setEnabled(False)
         vbox_layout.addWidget(self.vflip_button)
 
         # Add Horizontal Flip button.
         self.hflip_button = QPushButton('Flip Horizontal')
-        self.hflip_button.setStatusTip('Flip image across horizontal axis')
+        self.hflip_button.setStatusTip('Mirror image left to right')
         self.hflip_button.clicked.connect(self.on_hflip)
         self.hflip_button.setEnabled(False)
         vbox_layout.addWidget(self.hflip_button)
@@ -219,25 +301,122 @@ class MainWindow(QMainWindow):
         vbox_layout.addWidget(self.resize_button)
         vbox_layout.addStretch(8)
 
+    def add_browser(self):
+        # Create folder browser dock next to the Edit Image Tools dock.
+        self.prefetched = {}
+        self.browser = FolderBrowser(self)
+        self.browser.image_selected.connect(self.open_image)
+        self.addDockWidget(Qt.RightDockWidgetArea, self.browser)
+        self.tabifyDockWidget(self.dock, self.browser)
+        self.dock.raise_()
+        self.view_menu.addAction(self.browser.toggleViewAction())
+
+    def add_statusbar(self):
+        self.setStatusBar(QStatusBar())
+
+        # Add progress bar and Cancel button for background jobs.
+        self.progress_bar = QProgressBar()
+        self.progress_bar.setFixedWidth(120)
+        self.progress_bar.setRange(0, 100)
+        self.progress_bar.setVisible(False)
+        self.statusBar().addPermanentWidget(self.progress_bar)
+
+        self.cancel_button = QPushButton('Cancel')
+        self.cancel_button.setStatusTip('Cancel running image operations')
+        self.cancel_button.clicked.connect(self.on_cancel)
+        self.cancel_button.setVisible(False)
+        self.statusBar().addPermanentWidget(self.cancel_button)
+
     @pyqtSlot()
     def on_open(self):
         fname, _ = QFileDialog.getOpenFileName(
             self, 'Open Image', 'resources', 'JPG Files (*.jpeg *.jpg);;\
-            PNG Files (*.png);;Bitmap Files (*.bmp);;GIF Files (*.gif)')
+            PNG Files (*.png);;Bitmap Files (*.bmp);;GIF Files (*.gif);;\
+            TIFF Files (*.tif *.tiff)')
 
         if fname:
-            self.image = QPixmap(fname)
-            self.image_label.setPixmap(
-                self.image.scaled(
-                    self.image_label.size(), Qt.KeepAspectRatio,
-                    Qt.SmoothTransformation))
-
+            self.open_image(fname)
         else:
             QMessageBox.warning(
                 self, 'Open Image', 'Could not open image!', QMessageBox.Ok)
 
-        # Activate/Deactivate image editing widgets.
-        self.toggle_widgets(bool(fname))
+            # Deactivate image editing widgets.
+            self.toggle_widgets(False)
+
+    def open_image(self, fname):
+        # Use the neighbour prefetched while browsing a folder, if any.
+        pyramid = self.prefetched.pop(fname, None)
+        if pyramid is not None:
+            self.jobs.cancel('open')
+            self.on_opened(pyramid)
+            self.prefetch_neighbours(fname)
+            return
+
+        # Decode off the GUI thread; a newer open drops this one.
+        self.jobs.submit(
+            'open', load_image, fname, self.image_view.size(),
+            self.tile_cache, partial=self.on_open_preview,
+            finished=self.on_opened, error=self.on_open_error)
+        self.prefetch_neighbours(fname)
+
+    def prefetch_neighbours(self, fname):
+        """Decodes the images next to fname in the folder browser."""
+        neighbours = self.browser.neighbours(fname)
+        for path in list(self.prefetched):
+            if path not in neighbours:
+                del self.prefetched[path]
+        for path in neighbours:
+            if path not in self.prefetched:
+                self.browser.jobs.submit(
+                    ('prefetch', path), load_image, path,
+                    self.image_view.size(), self.tile_cache,
+                    finished=lambda pyramid, path=path:
+                        self.prefetched.__setitem__(path, pyramid))
+
+    @pyqtSlot()
+    def on_open_folder(self):
+        folder = QFileDialog.getExistingDirectory(
+            self, 'Open Folder', 'resources')
+        if folder:
+            self.browser.set_folder(folder)
+            self.browser.show()
+            self.browser.raise_()
+
+    def on_open_preview(self, preview):
+        """Shows a low resolution preview while the full decode runs."""
+        image, size = preview
+        # The current image and its edits stay until the open succeeds.
+        if not self.previewing:
+            self.previewing = True
+            self.previous_pyramid = self.image_view.pyramid
+        self.toggle_widgets(False)
+        self.image_view.set_pyramid(ImagePyramid(image, self.tile_cache))
+        self.image_view.set_transform(QTransform())
+        self.statusBar().showMessage(
+            f'Loading {size.width()} x {size.height()} px...')
+
+    def on_opened(self, pyramid):
+        self.previewing = False
+        self.previous_pyramid = None
+        self.set_image(pyramid.levels[0], pyramid)
+
+        # Activate image editing widgets.
+        self.toggle_widgets(True)
+
+    def on_open_error(self, message):
+        self.restore_image()
+        QMessageBox.warning(self, 'Open Image', message, QMessageBox.Ok)
+
+    def restore_image(self):
+        """Shows the current image again in place of a dropped preview."""
+        if not self.previewing:
+            return
+        self.image_view.set_pyramid(self.previous_pyramid)
+        self.previewing = False
+        self.previous_pyramid = None
+        self.statusBar().clearMessage()
+        self.update_view()
+        self.toggle_widgets(not self.image.isNull())
 
     def toggle_widgets(self, flag):
         self.save_action.setEnabled(flag)
@@ -253,6 +432,8 @@ class MainWindow(QMainWindow):
         self.vflip_button.setEnabled(flag)
         self.hflip_button.setEnabled(flag)
         self.resize_button.setEnabled(flag)
+        self.undo_action.setEnabled(flag and self.history.can_undo())
+        self.redo_action.setEnabled(flag and self.history.can_redo())
 
     @pyqtSlot()
     def on_save(self):
@@ -261,11 +442,40 @@ class MainWindow(QMainWindow):
             Bitmap Files (*.bmp);;GIF Files (*.gif)')
 
         if fname and (not self.image.isNull()):
-            self.image.save(fname)
+            dialog = SaveOptionsDialog(self.save_options, self)
+            if dialog.exec_() != QDialog.Accepted:
+                return
+            self.save_options = dialog.options()
+
+            # Resample and encode off the GUI thread.
+            self.jobs.submit(
+                ('save', fname), save_image, self.image, self.edits.copy(),
+                self.save_options.outputs(fname), self.save_options,
+                finished=self.on_saved, error=self.on_save_error)
         else:
             QMessageBox.warning(
                 self, 'Save Image', 'Cound not save image!', QMessageBox.Ok)
 
+    def on_saved(self, fnames):
+        self.statusBar().showMessage(f'Saved {", ".join(fnames)}', 5000)
+
+    def on_save_error(self, message):
+        QMessageBox.warning(self, 'Save Image', message, QMessageBox.Ok)
+
+    @pyqtSlot()
+    def on_cancel(self):
+        self.jobs.cancel_all()
+        self.restore_image()
+
+    def on_job_started(self):
+        self.progress_bar.setValue(0)
+        self.progress_bar.setVisible(True)
+        self.cancel_button.setVisible(True)
+
+    def on_jobs_idle(self):
+        self.progress_bar.setVisible(False)
+        self.cancel_button.setVisible(False)
+
     @pyqtSlot()
     def on_print(self):
         print('\tPrint image')
@@ -273,21 +483,26 @@ class MainWindow(QMainWindow):
 
     @pyqtSlot()
     def on_vflip(self):
-        pass
+        self.apply_edit('vflip')
 
     @pyqtSlot()
     def on_hflip(self):
-        print('\tFlip image horizontally')
-        pass
+        self.apply_edit('hflip')
 
     @pyqtSlot()
     def on_resize(self):
-        print('\tResize image')
-        pass
+        self.apply_edit('half')
 
     @pyqtSlot()
     def on_clear(self):
-        self.image_label.clear()
+        self.jobs.cancel('open')
+        self.previewing = False
+        self.previous_pyramid = None
+        self.image = QImage()
+        self.reset_edits()
+        self.image_view.clear()
+        self.tile_cache.clear()
+        self.preview_cache.clear()
         self.toggle_widgets(False)
 
     @pyqtSlot()
@@ -299,25 +514,1237 @@ class MainWindow(QMainWindow):
 
     @pyqtSlot()
     def on_rotate_90(self):
-        rotate90 = QTransform().rotate(90)
-        pixmap = QPixmap(self.image)
-        rotated = pixmap.transformed(rotate90, Qt.SmoothTransformation)
-        self.image_label.setPixmap(
-            rotated.scaled(self.image_label.size(), Qt.KeepAspectRatio,
-                           Qt.SmoothTransformation))
-        self.image = QPixmap(rotated)
-        self.image_label.repaint()
+        self.apply_edit('rotate90')
 
     @pyqtSlot()
     def on_rotate_180(self):
-        rotate180 = QTransform().rotate(180)
-        pixmap = QPixmap(self.image)
-        rotated = pixmap.transformed(rotate180, Qt.SmoothTransformation)
-        self.image_label.setPixmap(
-            rotated.scaled(self.image_label.size(), Qt.KeepAspectRatio,
-                           Qt.SmoothTransformation))
-        self.image = QPixmap(rotated)
-        self.image_label.repaint()
+        self.apply_edit('rotate180')
+
+    def apply_edit(self, name):
+        self.history.push(name)
+        self.edits = self.history.state()
+        self.update_view()
+        self.toggle_widgets(True)
+
+    @pyqtSlot()
+    def on_undo(self):
+        if self.history.can_undo():
+            self.edits = self.history.undo()
+            self.update_view()
+            self.toggle_widgets(True)
+
+    @pyqtSlot()
+    def on_redo(self):
+        if self.history.can_redo():
+            self.edits = self.history.redo()
+            self.update_view()
+            self.toggle_widgets(True)
+
+
+class FolderBrowser(QDockWidget):
+    """Filmstrip of the images in a folder.
+
+    Thumbnails are only made for the items scrolled into view, on a
+    background pool, and are kept in a ThumbnailCache on disk so that
+    reopening a folder is instant.
+    """
+
+    image_selected = pyqtSignal(str)
+
+    ICON_SIZE = 96
+
+    def __init__(self, parent=None):
+        super(FolderBrowser, self).__init__('Folder Browser', parent)
+        self.setAllowedAreas(Qt.LeftDockWidgetArea | Qt.RightDockWidgetArea)
+        self.cache = ThumbnailCache()
+        self.jobs = JobRunner(parent=self)
+        self.fnames = []
+        self.rows = {}
+        self.requested = set()
+
+        # Create filmstrip list.
+        self.list_widget = QListWidget()
+        self.list_widget.setViewMode(QListView.IconMode)
+        self.list_widget.setFlow(QListView.TopToBottom)
+        self.list_widget.setWrapping(False)
+        self.list_widget.setMovement(QListView.Static)
+        self.list_widget.setUniformItemSizes(True)
+        self.list_widget.setIconSize(QSize(self.ICON_SIZE, self.ICON_SIZE))
+        self.list_widget.currentRowChanged.connect(self.on_current_row)
+        self.list_widget.verticalScrollBar().valueChanged.connect(
+            self.request_visible)
+        self.setWidget(self.list_widget)
+
+        self.placeholder = QPixmap(self.ICON_SIZE, self.ICON_SIZE)
+        self.placeholder.fill(Qt.lightGray)
+
+    def set_folder(self, folder):
+        self.jobs.cancel_all()
+        self.requested.clear()
+        self.list_widget.clear()
+        self.fnames = list(iter_batch_files([folder]))
+        self.rows = {fname: row for row, fname in enumerate(self.fnames)}
+
+        icon = QIcon(self.placeholder)
+        for fname in self.fnames:
+            item = QListWidgetItem(icon, os.path.basename(fname))
+            item.setToolTip(fname)
+            self.list_widget.addItem(item)
+        self.request_visible()
+
+    def neighbours(self, fname):
+        row = self.rows.get(fname)
+        if row is None:
+            return []
+        return [self.fnames[i] for i in (row - 1, row + 1)
+                if 0 <= i < len(self.fnames)]
+
+    def on_current_row(self, row):
+        if 0 <= row < len(self.fnames):
+            self.image_selected.emit(self.fnames[row])
+
+    def request_visible(self):
+        """Queues thumbnails for the items in view and a few around them."""
+        if not self.fnames:
+            return
+        viewport = self.list_widget.viewport().rect()
+        first = self.list_widget.indexAt(viewport.topLeft() + QPoint(4, 4))
+        last = self.list_widget.indexAt(viewport.bottomLeft() + QPoint(4, -4))
+        first = first.row() if first.isValid() else 0
+        last = last.row() if last.isValid() else len(self.fnames) - 1
+
+        for row in range(max(first - 4, 0), min(last + 5, len(self.fnames))):
+            fname = self.fnames[row]
+            if fname not in self.requested:
+                self.requested.add(fname)
+                self.jobs.submit(
+                    ('thumbnail', fname), load_thumbnail, fname, self.cache,
+                    finished=lambda image, row=row: self.set_thumbnail(
+                        row, image))
+
+    def set_thumbnail(self, row, image):
+        item = self.list_widget.item(row)
+        if item is not None and not image.isNull():
+            item.setIcon(QIcon(QPixmap.fromImage(image)))
+
+    def resizeEvent(self, event):
+        super(FolderBrowser, self).resizeEvent(event)
+        self.request_visible()
+
+
+class ThumbnailCache:
+    """On-disk thumbnails following the freedesktop.org thumbnail spec.
+
+    Thumbnails are PNG files named after the MD5 of the image URI, with
+    the image's URI, mtime and size stored in text chunks. A thumbnail
+    whose mtime or size no longer match the image is made again.
+    """
+
+    SIZE = 128
+
+    def __init__(self, root=None):
+        if root is None:
+            root = os.path.join(
+                os.environ.get('XDG_CACHE_HOME') or
+                os.path.join(os.path.expanduser('~'), '.cache'),
+                'thumbnails')
+        self.folder = os.path.join(root, 'normal')
+
+    def path(self, uri):
+        return os.path.join(
+            self.folder, hashlib.md5(uri.encode()).hexdigest() + '.png')
+
+    def load(self, fname):
+        """Returns the thumbnail of fname, making it if needed."""
+        uri = QUrl.fromLocalFile(os.path.abspath(fname)).toString(
+            QUrl.FullyEncoded)
+        stat = os.stat(fname)
+        path = self.path(uri)
+
+        thumbnail = QImage(path)
+        if not thumbnail.isNull() and \
+                thumbnail.text('Thumb::URI') == uri and \
+                thumbnail.text('Thumb::MTime') == str(int(stat.st_mtime)) and \
+                thumbnail.text('Thumb::Size') == str(stat.st_size):
+            return thumbnail
+
+        reader = QImageReader(fname)
+        size = reader.size()
+        if size.isValid() and max(size.width(), size.height()) > self.SIZE:
+            reader.setScaledSize(
+                size.scaled(self.SIZE, self.SIZE, Qt.KeepAspectRatio))
+        thumbnail = reader.read()
+        if thumbnail.isNull():
+            return thumbnail
+
+        thumbnail.setText('Thumb::URI', uri)
+        thumbnail.setText('Thumb::MTime', str(int(stat.st_mtime)))
+        thumbnail.setText('Thumb::Size', str(stat.st_size))
+        try:
+            os.makedirs(self.folder, mode=0o700, exist_ok=True)
+            write_image(thumbnail, path, SaveOptions(), private=True)
+        except OSError:
+            pass  # A read-only cache only costs speed.
+        return thumbnail
+
+
+class SaveOptionsDialog(QDialog):
+    def __init__(self, options, parent=None):
+        super(SaveOptionsDialog, self).__init__(parent)
+        self.setWindowTitle('Save Options')
+        self.add_widgets(options)
+
+    def add_widgets(self, options):
+        form_layout = QFormLayout()
+        form_layout.setContentsMargins(8, 8, 8, 8)
+        self.setLayout(form_layout)
+
+        # Add JPEG quality spinbox.
+        self.quality_spinbox = QSpinBox()
+        self.quality_spinbox.setRange(1, 100)
+        self.quality_spinbox.setValue(options.quality)
+        form_layout.addRow('JPEG quality:', self.quality_spinbox)
+
+        # Add PNG compression level spinbox.
+        self.png_level_spinbox = QSpinBox()
+        self.png_level_spinbox.setRange(0, 9)
+        self.png_level_spinbox.setValue(options.png_level)
+        form_layout.addRow('PNG compression:', self.png_level_spinbox)
+
+        # Add JPEG optimize and progressive checkboxes.
+        self.optimize_checkbox = QCheckBox('Optimize JPEG encoding')
+        self.optimize_checkbox.setChecked(options.optimize)
+        form_layout.addRow(self.optimize_checkbox)
+        self.progressive_checkbox = QCheckBox('Progressive JPEG')
+        self.progressive_checkbox.setChecked(options.progressive)
+        form_layout.addRow(self.progressive_checkbox)
+
+        # Add web thumbnail checkbox and size.
+        self.thumbnail_checkbox = QCheckBox('Also save web thumbnail')
+        self.thumbnail_checkbox.setChecked(options.thumbnail_size > 0)
+        form_layout.addRow(self.thumbnail_checkbox)
+        self.thumbnail_spinbox = QSpinBox()
+        self.thumbnail_spinbox.setRange(16, 8192)
+        self.thumbnail_spinbox.setSuffix(' px')
+        self.thumbnail_spinbox.setValue(options.thumbnail_size or 1024)
+        self.thumbnail_spinbox.setEnabled(options.thumbnail_size > 0)
+        self.thumbnail_checkbox.toggled.connect(
+            self.thumbnail_spinbox.setEnabled)
+        form_layout.addRow('Thumbnail size:', self.thumbnail_spinbox)
+
+        buttons = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel)
+        buttons.accepted.connect(self.accept)
+        buttons.rejected.connect(self.reject)
+        form_layout.addRow(buttons)
+
+    def options(self):
+        options = SaveOptions()
+        options.quality = self.quality_spinbox.value()
+        options.png_level = self.png_level_spinbox.value()
+        options.optimize = self.optimize_checkbox.isChecked()
+        options.progressive = self.progressive_checkbox.isChecked()
+        if self.thumbnail_checkbox.isChecked():
+            options.thumbnail_size = self.thumbnail_spinbox.value()
+        return options
+
+
+class TransformStack:
+    """Records rotate, flip and resize edits as one composed matrix.
+
+    Edits only update the matrix, so they can be previewed cheaply by the
+    painter; the full resolution image is resampled once in apply(). Stacks
+    made only of quarter turns, flips and halvings are applied exactly on a
+    PixelBuffer instead.
+    """
+
+    def __init__(self):
+        self.ops = []
+        self.matrix = QTransform()
+
+    def push(self, op, transform):
+        self.ops.append(op)
+        self.matrix = self.matrix * transform
+
+    def rotate(self, degrees):
+        self.push(('rotate', degrees), QTransform().rotate(degrees))
+
+    def flip(self, horizontal=True):
+        if horizontal:
+            self.push(('hflip',), QTransform().scale(-1, 1))
+        else:
+            self.push(('vflip',), QTransform().scale(1, -1))
+
+    def scale(self, factor):
+        self.push(('scale', factor), QTransform().scale(factor, factor))
+
+    def reset(self):
+        self.ops = []
+        self.matrix = QTransform()
+
+    def copy(self):
+        stack = TransformStack()
+        stack.ops = list(self.ops)
+        stack.matrix = QTransform(self.matrix)
+        return stack
+
+    def simplified(self):
+        """Returns an equivalent stack with at most one edit of each kind.
+
+        Exact stacks reduce to one resize, an optional flip and one
+        rotation, however many edits they were built from.
+        """
+        if not self.is_exact():
+            return self.copy()
+
+        # Track the orientation as a flip followed by quarter turns; a flip
+        # after a rotation equals the flip before the inverse rotation.
+        scale, flip, quarter_turns = 1.0, False, 0
+        for op in self.ops:
+            if op[0] == 'scale':
+                scale *= op[1]
+            elif op[0] == 'rotate':
+                quarter_turns += op[1] // 90
+            elif op[0] == 'hflip':
+                flip, quarter_turns = not flip, -quarter_turns
+            elif op[0] == 'vflip':
+                flip, quarter_turns = not flip, 2 - quarter_turns
+
+        stack = TransformStack()
+        if scale != 1.0:
+            stack.scale(scale)
+        if flip:
+            stack.flip(horizontal=True)
+        if quarter_turns % 4:
+            stack.rotate(90 * (quarter_turns % 4))
+        return stack
+
+    def nbytes(self):
+        """Approximates the memory used by the recorded edits."""
+        return sys.getsizeof(self.ops) + sum(
+            sys.getsizeof(op) for op in self.ops) + sys.getsizeof(self.matrix)
+
+    def is_exact(self):
+        """Checks whether every edit maps pixels onto whole pixels."""
+        for op in self.ops:
+            if op[0] == 'rotate' and op[1] % 90:
+                return False
+            if op[0] == 'scale' and halvings(op[1]) is None:
+                return False
+        return True
+
+    def output_size(self, size):
+        """Returns the size of an image of `size` after all edits."""
+        if self.is_exact():
+            width, height = size.width(), size.height()
+            for op in self.ops:
+                if op[0] == 'scale':
+                    for _ in range(halvings(op[1])):
+                        width, height = (width + 1) // 2, (height + 1) // 2
+                elif op[0] == 'rotate' and op[1] % 180:
+                    width, height = height, width
+            return QSize(width, height)
+
+        rect = self.matrix.mapRect(QRectF(0, 0, size.width(), size.height()))
+        return QSize(max(1, round(rect.width())), max(1, round(rect.height())))
+
+    def apply(self, image):
+        """Resamples image once with the composed matrix."""
+        if not self.ops:
+            return image
+        if self.is_exact():
+            return self.apply_exact(PixelBuffer.from_qimage(image)).to_qimage()
+        return image.transformed(self.matrix, Qt.SmoothTransformation)
+
+    def apply_exact(self, buffer):
+        """Applies an exact stack to a PixelBuffer."""
+        # Halvings commute with the other edits, so shrink the pixels first.
+        for op in self.ops:
+            if op[0] == 'scale':
+                for _ in range(halvings(op[1])):
+                    buffer = buffer.halve()
+        for op in self.ops:
+            if op[0] == 'rotate':
+                buffer = buffer.rotate(op[1] // 90)
+            elif op[0] == 'hflip':
+                buffer = buffer.flip(horizontal=True)
+            elif op[0] == 'vflip':
+                buffer = buffer.flip(horizontal=False)
+        return buffer
+
+
+class EditHistory:
+    """Undo/redo history of edits kept within a memory budget.
+
+    Each step stores only the name of the edit. Every KEYFRAME_INTERVAL
+    steps the state is stored as a simplified TransformStack, and any
+    state is rebuilt by replaying fewer than KEYFRAME_INTERVAL edits on
+    the nearest keyframe, so undo and redo cost the same whatever the
+    image size or history length. The oldest steps are dropped once the
+    history outgrows max_bytes.
+    """
+
+    KEYFRAME_INTERVAL = 16
+
+    def __init__(self, max_bytes=1024 * 1024):
+        self.max_bytes = max_bytes
+        self.reset()
+
+    def reset(self):
+        self.ops = []  # ops[i] leads from state base + i to base + i + 1.
+        self.keyframes = {0: TransformStack()}
+        self.base = 0
+        self.position = 0
+
+    def can_undo(self):
+        return self.position > self.base
+
+    def can_redo(self):
+        return self.position < self.base + len(self.ops)
+
+    def push(self, name):
+        # A new edit discards the states that could have been redone.
+        del self.ops[self.position - self.base:]
+        for index in [i for i in self.keyframes if i > self.position]:
+            del self.keyframes[index]
+
+        stack = self.state()
+        EDITS[name](stack)
+        self.ops.append(name)
+        self.position += 1
+        if self.position % self.KEYFRAME_INTERVAL == 0:
+            self.keyframes[self.position] = stack.simplified()
+        self.trim()
+
+    def undo(self):
+        self.position -= 1
+        return self.state()
+
+    def redo(self):
+        self.position += 1
+        return self.state()
+
+    def state(self, index=None):
+        """Rebuilds the edits at index, the current position by default."""
+        if index is None:
+            index = self.position
+        start = max(index - index % self.KEYFRAME_INTERVAL, self.base)
+        stack = self.keyframes[start].copy()
+        for name in self.ops[start - self.base:index - self.base]:
+            EDITS[name](stack)
+        return stack
+
+    def nbytes(self):
+        return sys.getsizeof(self.ops) + sum(
+            stack.nbytes() for stack in self.keyframes.values())
+
+    def trim(self):
+        """Drops the oldest keyframe interval while over the budget."""
+        while self.nbytes() > self.max_bytes and len(self.keyframes) > 1:
+            base = min(i for i in self.keyframes if i > self.base)
+            if base > self.position:
+                break
+            del self.ops[:base - self.base]
+            del self.keyframes[self.base]
+            self.base = base
+
+
+def halvings(factor):
+    """Returns n if factor is 0.5 ** n, otherwise None."""
+    mantissa, exponent = math.frexp(factor)
+    if mantissa != 0.5 or exponent > 1:
+        return None
+    return 1 - exponent
+
+
+# Edits by name, shared by the GUI handlers and batch mode.
+EDITS = {
+    'rotate90': lambda edits: edits.rotate(90),
+    'rotate180': lambda edits: edits.rotate(180),
+    'vflip': lambda edits: edits.flip(horizontal=False),
+    'hflip': lambda edits: edits.flip(horizontal=True),
+    'half': lambda edits: edits.scale(0.5),
+}
+
+
+class PixelBuffer:
+    """Image pixels in a NumPy array with zero-copy QImage interop.
+
+    The array holds one uint32 per pixel in the layout of QImage's 32-bit
+    formats. Quarter turns and flips only return strided views, so the
+    pixels are copied once, when to_qimage() makes them contiguous.
+    """
+
+    FORMATS = (QImage.Format_RGB32, QImage.Format_ARGB32,
+               QImage.Format_ARGB32_Premultiplied)
+
+    def __init__(self, array, format=QImage.Format_ARGB32_Premultiplied):
+        self.array = array
+        self.format = format
+
+    @classmethod
+    def from_qimage(cls, image):
+        """Wraps the memory of image, converting it only if not 32-bit.
+
+        The array is read-only, since the pixels may be shared with other
+        copies of the image, and it keeps the image alive.
+        """
+        if image.format() not in cls.FORMATS:
+            image = image.convertToFormat(QImage.Format_ARGB32_Premultiplied)
+        memory = (ctypes.c_char * image.sizeInBytes()).from_address(
+            int(image.constBits()))
+        memory.image = image
+        array = np.frombuffer(memory, np.uint32).reshape(
+            image.height(), image.bytesPerLine() // 4)[:, :image.width()]
+        array.flags.writeable = False
+        return cls(array, image.format())
+
+    def to_qimage(self):
+        """Returns a QImage over the pixels, copying only strided views."""
+        array = np.ascontiguousarray(self.array)
+        height, width = array.shape
+        image = QImage(array.data, width, height, array.strides[0],
+                       self.format)
+        # Keep the pixels alive for as long as the image.
+        image.buffer = array
+        return image
+
+    def rotate(self, quarter_turns):
+        """Rotates clockwise by a multiple of 90°."""
+        return PixelBuffer(np.rot90(self.array, -quarter_turns), self.format)
+
+    def flip(self, horizontal=True):
+        if horizontal:
+            array = self.array[:, ::-1]
+        else:
+            array = self.array[::-1]
+        return PixelBuffer(array, self.format)
+
+    def halve(self):
+        """Downsamples by 2 with a box filter; odd edges are repeated."""
+        height, width = self.array.shape
+        channels = self.array.view(np.uint8).reshape(height, width, 4)
+
+        # Sum each 2x2 block per channel.
+        total = channels[0::2, 0::2].astype(np.uint16)
+        total[:, :width // 2] += channels[0::2, 1::2]
+        total[:height // 2] += channels[1::2, 0::2]
+        total[:height // 2, :width // 2] += channels[1::2, 1::2]
+        if width % 2:
+            total[:, -1] += channels[0::2, -1]
+            total[:height // 2, -1] += channels[1::2, -1]
+        if height % 2:
+            total[-1] += channels[-1, 0::2]
+            total[-1, :width // 2] += channels[-1, 1::2]
+        if width % 2 and height % 2:
+            total[-1, -1] += channels[-1, -1]
+
+        total += 2
+        total >>= 2
+        array = total.astype(np.uint8).view(np.uint32)[..., 0]
+        return PixelBuffer(array, self.format)
+
+
+class PixmapCache:
+    """LRU cache of pixmaps, bounded by their total size in bytes."""
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._tiles = OrderedDict()
+
+    def get(self, key):
+        pixmap = self._tiles.get(key)
+        if pixmap is not None:
+            self._tiles.move_to_end(key)
+        return pixmap
+
+    def put(self, key, pixmap):
+        if key in self._tiles:
+            self.nbytes -= pixmap_nbytes(self._tiles.pop(key))
+        self._tiles[key] = pixmap
+        self.nbytes += pixmap_nbytes(pixmap)
+
+        # Evict least recently used tiles, but always keep the newest one.
+        while self.nbytes > self.max_bytes and len(self._tiles) > 1:
+            _, evicted = self._tiles.popitem(last=False)
+            self.nbytes -= pixmap_nbytes(evicted)
+
+    def clear(self):
+        self._tiles.clear()
+        self.nbytes = 0
+
+
+# Pyramids are built on several pools at once; next() on a count is atomic.
+PYRAMID_IDS = itertools.count()
+
+
+class ImagePyramid:
+    """Multi-resolution, tiled view of an image.
+
+    Level 0 is the full resolution image and every following level halves
+    the previous one. Levels are built lazily and only the tiles that are
+    actually drawn are converted to pixmaps and kept in a PixmapCache.
+    """
+
+    TILE_SIZE = 256
+
+    def __init__(self, image, cache):
+        self.levels = [image]
+        self.cache = cache
+        self.id = next(PYRAMID_IDS)
+
+        # Halve until the whole image fits in a single tile.
+        self.level_count = 1
+        side = max(image.width(), image.height())
+        while side > self.TILE_SIZE:
+            side = (side + 1) // 2
+            self.level_count += 1
+
+    def size(self):
+        return self.levels[0].size()
+
+    def level(self, n):
+        """Returns level n, downsampling from the previous level if needed."""
+        n = min(max(n, 0), self.level_count - 1)
+        while len(self.levels) <= n:
+            previous = PixelBuffer.from_qimage(self.levels[-1])
+            self.levels.append(previous.halve().to_qimage())
+        return self.levels[n]
+
+    def level_for_scale(self, scale):
+        """Returns the smallest level that still has at least `scale` detail."""
+        if scale <= 0:
+            return self.level_count - 1
+        n = int(math.floor(math.log2(1 / scale))) if scale < 1 else 0
+        return min(max(n, 0), self.level_count - 1)
+
+    def tile(self, n, col, row):
+        key = (self.id, n, col, row)
+        pixmap = self.cache.get(key)
+        if pixmap is None:
+            size = self.TILE_SIZE
+            level = self.level(n)
+            # Edge tiles are cut to the level; QImage.copy would pad them
+            # with black (or transparent) pixels.
+            x, y = col * size, row * size
+            pixmap = QPixmap.fromImage(level.copy(
+                x, y, min(size, level.width() - x),
+                min(size, level.height() - y)))
+            self.cache.put(key, pixmap)
+        return pixmap
+
+    def tiles(self, n, rect):
+        """Yields (position, pixmap) for the level n tiles intersecting rect."""
+        size = self.TILE_SIZE
+        rect = rect.intersected(self.level(n).rect())
+        if rect.isEmpty():
+            return
+        for row in range(rect.top() // size, rect.bottom() // size + 1):
+            for col in range(rect.left() // size, rect.right() // size + 1):
+                yield QPointF(col * size, row * size), self.tile(n, col, row)
+
+    def preview(self, size):
+        """Scales the nearest level at or above `size` to fit inside it."""
+        full = self.size()
+        scale = min(size.width() / max(full.width(), 1),
+                    size.height() / max(full.height(), 1))
+        level = self.level(self.level_for_scale(scale))
+        return QPixmap.fromImage(level.scaled(
+            size, Qt.KeepAspectRatio, Qt.SmoothTransformation))
+
+
+class ImageView(QWidget):
+    """Image display that only draws the pyramid tiles in the viewport.
+
+    At the default zoom the image is fitted to the widget from a preview
+    cached by image, edits and size. A new preview is first drawn with a
+    fast nearest-neighbour pass and refined to smooth quality once the
+    view has been idle for REFINE_DELAY ms. Scrolling the mouse wheel
+    zooms in around the cursor and dragging pans; the view then paints
+    tiles from the nearest level. Pending edits are previewed by drawing
+    through their matrix.
+    """
+
+    MAX_ZOOM = 64
+    REFINE_DELAY = 150
+
+    def __init__(self, cache, parent=None):
+        super(ImageView, self).__init__(parent)
+        self.cache = cache
+        self.pyramid = None
+        self.transform = QTransform()
+        self.zoom = 1.0
+        self.pan = QPointF()
+        self._drag_pos = None
+
+        self._refine_timer = QTimer(self)
+        self._refine_timer.setSingleShot(True)
+        self._refine_timer.setInterval(self.REFINE_DELAY)
+        self._refine_timer.timeout.connect(self.refine_preview)
+
+    def set_pyramid(self, pyramid):
+        self.pyramid = pyramid
+        self.zoom = 1.0
+        self.pan = QPointF()
+        self.update()
+
+    def set_transform(self, transform):
+        self.transform = QTransform(transform)
+        self.update()
+
+    def clear(self):
+        self.set_pyramid(None)
+
+    def image_rect(self):
+        """Returns where the edited image lands in the widget."""
+        bounds = self.edited_bounds()
+        width, height = max(bounds.width(), 1), max(bounds.height(), 1)
+        scale = min(self.width() / width, self.height() / height) * self.zoom
+        rect = QRectF(0, 0, width * scale, height * scale)
+        rect.moveCenter(QRectF(self.rect()).center() + self.pan)
+        return rect
+
+    def edited_bounds(self):
+        size = self.pyramid.size()
+        return self.transform.mapRect(
+            QRectF(0, 0, size.width(), size.height()))
+
+    def world_transform(self, target):
+        """Maps full resolution image coordinates onto target."""
+        bounds = self.edited_bounds()
+        fit = target.width() / max(bounds.width(), 1)
+        return self.transform * QTransform.fromTranslate(
+            -bounds.left(), -bounds.top()) * QTransform.fromScale(
+            fit, fit) * QTransform.fromTranslate(target.left(), target.top())
+
+    def preview_key(self, size):
+        """Identifies a fitted preview by image, orientation and size."""
+        scale = math.sqrt(abs(self.transform.determinant())) or 1
+        orientation = tuple(round(value / scale, 6) for value in (
+            self.transform.m11(), self.transform.m12(),
+            self.transform.m21(), self.transform.m22()))
+        return self.pyramid.id, orientation, size.width(), size.height()
+
+    def render_preview(self, size, smooth):
+        """Renders the edited image fitted to size from the nearest level."""
+        world = self.world_transform(QRectF(0, 0, size.width(), size.height()))
+        full = self.pyramid.size()
+        scale = math.sqrt(abs(world.determinant()))
+
+        pixmap = QPixmap(size)
+        pixmap.fill(Qt.transparent)
+        painter = QPainter(pixmap)
+        if smooth:
+            source = self.pyramid.preview(QSize(
+                max(1, round(full.width() * scale)),
+                max(1, round(full.height() * scale))))
+            painter.setRenderHint(QPainter.SmoothPixmapTransform)
+        else:
+            source = self.pyramid.level(self.pyramid.level_for_scale(scale))
+        painter.setTransform(QTransform.fromScale(
+            full.width() / source.width(),
+            full.height() / source.height()) * world)
+        if smooth:
+            painter.drawPixmap(0, 0, source)
+        else:
+            painter.drawImage(0, 0, source)
+        painter.end()
+        return pixmap
+
+    def refine_preview(self):
+        """Replaces the fast preview on screen with a smooth one."""
+        if self.pyramid is None or self.zoom != 1.0:
+            return
+        size = self.image_rect().size().toSize()
+        key = self.preview_key(size)
+        if self.cache.get(key + (True,)) is None:
+            self.cache.put(key + (True,), self.render_preview(size, True))
+            self.update()
+
+    def paintEvent(self, event):
+        if self.pyramid is None:
+            return
+
+        painter = QPainter(self)
+        painter.setRenderHint(QPainter.SmoothPixmapTransform)
+        target = self.image_rect()
+
+        if self.zoom == 1.0:
+            # Fitted view; states seen before are painted from the cache.
+            size = target.size().toSize()
+            key = self.preview_key(size)
+            pixmap = self.cache.get(key + (True,))
+            if pixmap is None:
+                pixmap = self.cache.get(key + (False,))
+                if pixmap is None:
+                    pixmap = self.render_preview(size, False)
+                    self.cache.put(key + (False,), pixmap)
+                self._refine_timer.start()
+            painter.drawPixmap(target.topLeft(), pixmap)
+            return
+
+        world = self.world_transform(target)
+        size = self.pyramid.size()
+
+        # Screen pixels per full resolution pixel.
+        scale = math.sqrt(abs(world.determinant()))
+
+        n = self.pyramid.level_for_scale(scale)
+        level = self.pyramid.level(n)
+        level_world = QTransform.fromScale(
+            size.width() / level.width(),
+            size.height() / level.height()) * world
+
+        # Map the exposed area back into level coordinates.
+        exposed = QRectF(event.rect()).intersected(target)
+        inverted, _ = level_world.inverted()
+        visible = inverted.mapRect(exposed).toAlignedRect()
+
+        painter.setTransform(level_world)
+        for pos, pixmap in self.pyramid.tiles(n, visible):
+            painter.drawPixmap(pos, pixmap)
+
+    def wheelEvent(self, event):
+        if self.pyramid is None:
+            return
+        steps = event.angleDelta().y() / 120
+        zoom = min(max(self.zoom * 1.25 ** steps, 1.0), self.MAX_ZOOM)
+
+        # Keep the point under the cursor fixed while zooming.
+        center = QRectF(self.rect()).center()
+        anchor = QPointF(event.pos()) - center - self.pan
+        self.pan += anchor - anchor * (zoom / self.zoom)
+        if zoom == 1.0:
+            self.pan = QPointF()
+        self.zoom = zoom
+        self.update()
+
+    def mousePressEvent(self, event):
+        if event.button() == Qt.LeftButton:
+            self._drag_pos = event.pos()
+
+    def mouseMoveEvent(self, event):
+        if self._drag_pos is not None and self.zoom > 1.0:
+            self.pan += QPointF(event.pos() - self._drag_pos)
+            self.update()
+        self._drag_pos = event.pos()
+
+    def mouseReleaseEvent(self, event):
+        self._drag_pos = None
+
+
+class JobCancelled(Exception):
+    """Raised inside a job when it has been cancelled or superseded."""
+
+
+class JobSignals(QObject):
+    progress = pyqtSignal(int)
+    partial = pyqtSignal(object)
+    finished = pyqtSignal(object)
+    error = pyqtSignal(str)
+
+
+class Job(QRunnable):
+    """Runs fn(job, *args) on a thread pool and reports through signals.
+
+    The function may call job.report() between steps; once the job has
+    been cancelled report() raises JobCancelled so the work stops early.
+    Intermediate results can be handed out early with job.publish().
+    """
+
+    def __init__(self, fn, *args):
+        super(Job, self).__init__()
+        self.setAutoDelete(False)
+        self.fn = fn
+        self.args = args
+        self.cancelled = False
+        self.signals = JobSignals()
+
+    def cancel(self):
+        self.cancelled = True
+
+    def report(self, percent):
+        if self.cancelled:
+            raise JobCancelled()
+        self.signals.progress.emit(percent)
+
+    def publish(self, result):
+        if self.cancelled:
+            raise JobCancelled()
+        self.signals.partial.emit(result)
+
+    def run(self):
+        try:
+            result = self.fn(self, *self.args)
+        except JobCancelled:
+            return
+        except Exception as e:
+            if not self.cancelled:
+                self.signals.error.emit(str(e))
+            return
+        if not self.cancelled:
+            self.signals.finished.emit(result)
+
+
+class JobRunner(QObject):
+    """Submits jobs to a QThreadPool, one in flight per key.
+
+    Submitting a job under a key that already has one in flight cancels
+    the older job, and any result it still produces is dropped. Results
+    are delivered to the GUI thread through queued signals.
+
+    Jobs run on a private pool: Qt itself uses the global pool, e.g. for
+    smooth scaling, and waits on it while holding the GIL.
+    """
+
+    started = pyqtSignal()
+    progress = pyqtSignal(int)
+    idle = pyqtSignal()
+
+    def __init__(self, pool=None, parent=None):
+        super(JobRunner, self).__init__(parent)
+        self.pool = pool or QThreadPool(self)
+        self.jobs = {}
+
+    def submit(self, key, fn, *args, partial=None, finished=None, error=None):
+        self.cancel(key)
+        job = Job(fn, *args)
+        job.signals.progress.connect(
+            lambda percent: self._on_progress(key, job, percent))
+        job.signals.partial.connect(
+            lambda result: self._on_partial(key, job, partial, result))
+        job.signals.finished.connect(
+            lambda result: self._on_done(key, job, finished, result))
+        job.signals.error.connect(
+            lambda message: self._on_done(key, job, error, message))
+
+        if not self.jobs:
+            self.started.emit()
+        self.jobs[key] = job
+        self.pool.start(job)
+        return job
+
+    def cancel(self, key):
+        job = self.jobs.pop(key, None)
+        if job is not None:
+            job.cancel()
+            self.pool.tryTake(job)
+            if not self.jobs:
+                self.idle.emit()
+
+    def cancel_all(self):
+        for key in list(self.jobs):
+            self.cancel(key)
+
+    def _on_progress(self, key, job, percent):
+        if self.jobs.get(key) is job:
+            self.progress.emit(percent)
+
+    def _on_partial(self, key, job, callback, value):
+        if self.jobs.get(key) is job and callback is not None:
+            callback(value)
+
+    def _on_done(self, key, job, callback, value):
+        # Drop results of jobs that were cancelled or superseded.
+        if self.jobs.get(key) is not job:
+            return
+        del self.jobs[key]
+        if callback is not None:
+            callback(value)
+        if not self.jobs:
+            self.idle.emit()
+
+
+def load_image(job, fname, view_size, cache):
+    """Decodes fname and builds the pyramid levels needed to preview it.
+
+    The file is read through mmap. A fast preview is published first, then
+    the full image is decoded straight from the mapped pages.
+    """
+    try:
+        with open(fname, 'rb') as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            preview = read_preview(data, fname, view_size)
+            if preview is not None:
+                job.publish(preview)
+            job.report(10)
+            image = QImage.fromData(data)
+    except (OSError, ValueError):
+        image = QImage()
+    if image.isNull():
+        raise ValueError('Could not open image!')
+    job.report(50)
+
+    pyramid = ImagePyramid(image, cache)
+    scale = min(view_size.width() / max(image.width(), 1),
+                view_size.height() / max(image.height(), 1))
+    for n in range(1, pyramid.level_for_scale(scale) + 1):
+        pyramid.level(n)
+        job.report(50 + 50 * n // pyramid.level_count)
+    return pyramid
+
+
+def read_preview(data, fname, view_size):
+    """Returns (preview, full size) for a quick first paint, or None.
+
+    JPEG files are previewed from their EXIF thumbnail when they have one
+    and otherwise from a DCT-scaled decode, both of which only touch a
+    fraction of the file. Other formats have no cheap preview.
+    """
+    if data[:2] != b'\xff\xd8':
+        return None
+
+    reader = QImageReader(fname)
+    size = reader.size()
+    thumbnail = read_exif_thumbnail(data)
+    if thumbnail is not None:
+        preview = QImage.fromData(thumbnail, 'JPG')
+    else:
+        reader.setScaledSize(size.scaled(view_size, Qt.KeepAspectRatio))
+        preview = reader.read()
+    if preview.isNull() or not size.isValid():
+        return None
+    return preview, size
+
+
+def read_exif_thumbnail(data):
+    """Returns the JPEG thumbnail embedded in a JPEG's EXIF data, or None."""
+    pos = 2
+    while pos + 4 <= len(data) and data[pos] == 0xFF:
+        marker = data[pos + 1]
+        if marker == 0xDA:  # Start of scan; no more metadata.
+            return None
+        length = int.from_bytes(data[pos + 2:pos + 4], 'big')
+        if marker == 0xE1 and data[pos + 4:pos + 10] == b'Exif\0\0':
+            return read_tiff_thumbnail(data, pos + 10, pos + 2 + length)
+        pos += 2 + length
+    return None
+
+
+def read_tiff_thumbnail(data, start, end):
+    """Reads the IFD1 JPEG thumbnail of the TIFF structure in EXIF data."""
+    header = data[start:start + 8]
+    if header[:2] not in (b'II', b'MM'):
+        return None
+    order = 'little' if header[:2] == b'II' else 'big'
+
+    def read(offset, size):
+        return int.from_bytes(
+            data[start + offset:start + offset + size], order)
+
+    # Skip IFD0 to reach IFD1, which describes the thumbnail.
+    ifd = read(4, 4)
+    count = read(ifd, 2)
+    ifd = read(ifd + 2 + 12 * count, 4)
+    if not ifd or start + ifd + 2 > end:
+        return None
+
+    offset = length = None
+    for i in range(read(ifd, 2)):
+        entry = ifd + 2 + 12 * i
+        tag = read(entry, 2)
+        if tag == 0x0201:
+            offset = read(entry + 8, 4)
+        elif tag == 0x0202:
+            length = read(entry + 8, 4)
+    if not offset or not length or start + offset + length > end:
+        return None
+
+    thumbnail = data[start + offset:start + offset + length]
+    return thumbnail if thumbnail[:2] == b'\xff\xd8' else None
+
+
+class SaveOptions:
+    """Encoder settings and extra outputs for saving an image."""
+
+    def __init__(self, quality=90, png_level=6, optimize=True,
+                 progressive=False, thumbnail_size=0):
+        self.quality = quality
+        self.png_level = png_level
+        self.optimize = optimize
+        self.progressive = progressive
+        self.thumbnail_size = thumbnail_size
+
+    def outputs(self, fname):
+        """Returns (file name, max side or 0 for full size) to write."""
+        outputs = [(fname, 0)]
+        if self.thumbnail_size:
+            root, ext = os.path.splitext(fname)
+            outputs.append((f'{root}_web{ext}', self.thumbnail_size))
+        return outputs
+
+
+def load_thumbnail(job, fname, cache):
+    return cache.load(fname)
+
+
+def save_image(job, image, edits, outputs, options):
+    """Applies the edits to the full resolution image once and writes
+    every output in parallel."""
+    job.report(0)
+    edited = edits.apply(image)
+    job.report(50)
+
+    def write(output):
+        fname, max_side = output
+        if max_side:
+            write_image(scale_to_fit(edited, max_side), fname, options)
+        else:
+            write_image(edited, fname, options)
+        return fname
+
+    with ThreadPoolExecutor(max_workers=len(outputs)) as executor:
+        fnames = list(executor.map(write, outputs))
+    job.report(100)
+    return fnames
+
+
+def write_image(image, fname, options, private=False):
+    """Encodes image to fname atomically.
+
+    The encoder streams into a temporary file next to fname, which is
+    flushed to disk and then renamed over fname, so fname is never left
+    half written. A private file stays readable by the owner only.
+    """
+    ext = os.path.splitext(fname)[1].lower()
+    fmt = ext[1:] or 'png'
+    fd, tmp_name = tempfile.mkstemp(
+        suffix=ext, prefix='.', dir=os.path.dirname(os.path.abspath(fname)))
+    os.close(fd)
+
+    try:
+        writer = QImageWriter(tmp_name, fmt.encode())
+        if fmt in ('jpg', 'jpeg'):
+            writer.setQuality(options.quality)
+            writer.setOptimizedWrite(options.optimize)
+            writer.setProgressiveScanWrite(options.progressive)
+        elif fmt == 'png':
+            # Qt's PNG writer maps quality 100..0 onto zlib levels 0..9.
+            writer.setQuality(100 - 11 * options.png_level)
+        if not writer.write(image):
+            raise IOError(f'Could not save {fname}: {writer.errorString()}')
+        del writer
+
+        with open(tmp_name, 'rb+') as f:
+            os.fsync(f.fileno())
+        if not private:
+            keep_mode(fname, tmp_name)
+        os.replace(tmp_name, fname)
+    except BaseException:
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+        raise
+
+
+def scale_to_fit(image, max_side):
+    """Shrinks image to fit max_side, halving exactly while it can."""
+    buffer = PixelBuffer.from_qimage(image)
+    while max(buffer.array.shape) >= 2 * max_side:
+        buffer = buffer.halve()
+    image = buffer.to_qimage()
+    if max(image.width(), image.height()) > max_side:
+        image = image.scaled(
+            max_side, max_side, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+    return image
+
+
+IMAGE_EXTENSIONS = ('.bmp', '.gif', '.jpeg', '.jpg', '.png', '.tif', '.tiff',
+                    '.webp')
+
+
+def iter_batch_files(sources):
+    """Yields image files from directories, glob patterns and paths."""
+    for source in sources:
+        if os.path.isdir(source):
+            with os.scandir(source) as entries:
+                for entry in sorted(entries, key=lambda e: e.name):
+                    if entry.is_file() and \
+                            entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                        yield entry.path
+        elif glob.has_magic(source):
+            yield from sorted(glob.iglob(source))
+        else:
+            yield source
+
+
+def batch_process(task):
+    """Applies the edits to one file; runs in a batch worker process."""
+    fname, ops, out_dir, fmt, options = task
+    name, ext = os.path.splitext(os.path.basename(fname))
+    out_name = os.path.join(out_dir, name + ('.' + fmt if fmt else ext))
+
+    image = QImage(fname)
+    if image.isNull():
+        return fname, None, 'Could not open image!'
+
+    edits = TransformStack()
+    for op in ops:
+        EDITS[op](edits)
+    try:
+        write_image(edits.apply(image), out_name, options)
+    except OSError as e:
+        return fname, None, str(e)
+    return fname, out_name, None
+
+
+def batch_main(argv):
+    """Runs the edit pipeline over many files without a display."""
+    parser = argparse.ArgumentParser(
+        prog='photoeditor.py batch',
+        description='Apply photo editor edits to many images.')
+    parser.add_argument(
+        'sources', nargs='+', help='image files, directories or glob patterns')
+    parser.add_argument(
+        '-e', '--edits', required=True,
+        help='comma separated edits applied in order: ' + ', '.join(EDITS))
+    parser.add_argument(
+        '-o', '--output', required=True, help='output directory')
+    parser.add_argument(
+        '-f', '--format', help='output format, e.g. png (default: keep)')
+    parser.add_argument(
+        '-q', '--quality', type=int, default=90,
+        help='JPEG quality, 1-100 (default: 90)')
+    parser.add_argument(
+        '--png-level', type=int, default=6, choices=range(10),
+        metavar='0-9', help='PNG compression level (default: 6)')
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=os.cpu_count() or 1,
+        help='worker processes (default: all cores)')
+    args = parser.parse_args(argv)
+
+    ops = [op.strip() for op in args.edits.split(',') if op.strip()]
+    unknown = [op for op in ops if op not in EDITS]
+    if unknown:
+        parser.error(f'unknown edits: {", ".join(unknown)}')
+    os.makedirs(args.output, exist_ok=True)
+
+    options = SaveOptions(quality=args.quality, png_level=args.png_level)
+    tasks = ((fname, ops, args.output, args.format, options)
+             for fname in iter_batch_files(args.sources))
+    done = failed = 0
+    start = time.perf_counter()
+
+    # Results are written by the workers and streamed back as they finish.
+    with multiprocessing.Pool(max(1, args.jobs)) as pool:
+        for fname, out_name, error in pool.imap_unordered(
+                batch_process, tasks, chunksize=4):
+            if error:
+                failed += 1
+                print(f'{fname}: {error}', file=sys.stderr)
+            else:
+                done += 1
+                print(f'{fname} -> {out_name}')
+
+    elapsed = time.perf_counter() - start
+    print(f'{done} images in {elapsed:.2f} s '
+          f'({done / elapsed if elapsed else 0:.1f} images/s), '
+          f'{failed} failed')
+    return 1 if failed else 0
+
+
+def pixmap_nbytes(pixmap):
+    """Approximates the memory used by a pixmap."""
+    return pixmap.width() * pixmap.height() * pixmap.depth() // 8
 
 
 def abspath(path):
@@ -328,6 +1755,9 @@ def abspath(path):
 
 
 if __name__ == '__main__':
+    if sys.argv[1:2] == ['batch']:
+        sys.exit(batch_main(sys.argv[2:]))
+
     app = QApplication(sys.argv)
     main_window = MainWindow()
     sys.exit(app.exec_())
@@ -11,26 +11,50 @@ SpinWheel GUI; randomly selects an item from a list.
 --- Copyright (C) 2021 MAI Enterprises ---
 """
 
+import argparse
+import bisect
+import codecs
+import csv
+import heapq
+import math
 import os
 import random
+import statistics
+import subprocess
 import sys
+import tempfile
 import time
 
-import matplotlib.pyplot as plt
-import numpy as np
 from PyQt5.QtWidgets import (
     QApplication, QMainWindow, QAction, QWidget, QVBoxLayout, QLabel, QLineEdit,
     QTabWidget, QTextEdit, QScrollBar, QMessageBox, QHBoxLayout, QSpinBox,
-    QFormLayout, QPushButton, QFileDialog)
-from PyQt5.QtGui import QIcon, QPixmap, QTransform
-from PyQt5.QtCore import pyqtSlot, Qt, QSize
+    QFormLayout, QPushButton, QFileDialog, QStatusBar, QProgressBar)
+from PyQt5.QtGui import (
+    QIcon, QPixmap, QPainter, QColor, QPen, QFontMetrics,
+    QStaticText, QTextCursor)
+from PyQt5.QtCore import (
+    pyqtSlot, Qt, QSize, QRectF, QPointF, QObject, QEvent, QTimer,
+    QVariantAnimation, QEasingCurve)
+
+from textfile import keep_mode
 
 
 class MainWindow(QMainWindow):
     def __init__(self):
         super(MainWindow, self).__init__()
 
-        self.items = []
+        # One entry per line of the items editor, kept in step by
+        # on_contents_change; an empty editor has a single empty line.
+        self.items = ['']
+        self.labels = ['']
+        self.weights = [1.0]
+        self.drawable = 1
+        self.items_changed = False
+        self.selector = Selector(self.weights)
+        self.slot = None
+        self.removed = None
+        self.spinning = False
+        self.wheel_renderer = WheelRenderer(QSize(300, 300))
 
         self.setFixedSize(400, 420)
         self.setWindowTitle('SpinWheel')
@@ -44,13 +68,13 @@ class MainWindow(QMainWindow):
     def create_actions(self):
         # Import
         self.import_action = QAction('Import...', self)
-        self.import_action.setStatusTip('Import items from *.txt')
+        self.import_action.setStatusTip('Import items from *.txt or *.csv')
         self.import_action.setShortcut('Ctrl+I')
         self.import_action.triggered.connect(self.on_import)
 
         # Export
         self.export_action = QAction('Export...', self)
-        self.export_action.setStatusTip('Export items to *.txt')
+        self.export_action.setStatusTip('Export items to *.txt or *.csv')
         self.export_action.setShortcut('Ctrl+E')
         self.export_action.triggered.connect(self.on_export)
         self.export_action.setEnabled(False)
@@ -70,21 +94,118 @@ class MainWindow(QMainWindow):
     @pyqtSlot()
     def on_import(self):
         fname, _ = QFileDialog.getOpenFileName(
-            self, 'Import TXT', 'resources', 'Text Files (*.txt)')
+            self, 'Import Items', 'resources',
+            'Text Files (*.txt);;CSV Files (*.csv)')
 
         if fname:
-            with open(fname, 'r') as f:
-                self.items = f.readlines()
-                self.items_edit.setText(''.join(self.items))
+            self.start_transfer(
+                self.import_steps(fname), f'Importing {fname}...')
 
     @pyqtSlot()
     def on_export(self):
-        text = '\n'.join(self.items)
         fname, _ = QFileDialog.getSaveFileName(
-            self, 'Export TXT', 'resources', 'Text Files (*.txt)')
+            self, 'Export Items', 'resources',
+            'Text Files (*.txt);;CSV Files (*.csv)')
+
         if fname:
-            with open(fname, 'w') as f:
-                f.write(text)
+            # Apply any edit still waiting on the debounce timer.
+            self.items_timer.stop()
+            self.on_items()
+            self.start_transfer(
+                self.export_steps(fname), f'Exporting {fname}...')
+
+    def import_steps(self, fname):
+        """Fills the items document from fname a chunk at a time."""
+        size = os.path.getsize(fname) or 1
+        document = self.items_edit.document()
+        # Undo would keep a second copy of the whole list.
+        document.setUndoRedoEnabled(False)
+        self.items_edit.clear()
+        cursor = QTextCursor(document)
+        try:
+            with open_text(fname) as f:
+                pending = ''
+                for chunk in iter_item_chunks(f, is_csv(fname)):
+                    # Hold back a trailing newline; it ends the last item
+                    # rather than starting an empty one.
+                    text = pending + chunk
+                    pending = '\n' if text.endswith('\n') else ''
+                    cursor.insertText(text[:len(text) - len(pending)])
+                    yield f.buffer.tell() / size
+        finally:
+            document.setUndoRedoEnabled(True)
+
+    def export_steps(self, fname):
+        """Writes the items to fname atomically, a batch at a time."""
+        items = self.items
+        fd, tmp_name = tempfile.mkstemp(
+            suffix='.tmp', prefix='.',
+            dir=os.path.dirname(os.path.abspath(fname)))
+        try:
+            with open(fd, 'w', encoding='utf-8', newline='') as f:
+                writer = csv.writer(f, lineterminator='\n')
+                if is_csv(fname):
+                    writer.writerow(CSV_HEADER)
+                for start in range(0, len(items), 10000):
+                    batch = items[start:start + 10000]
+                    if is_csv(fname):
+                        writer.writerows(
+                            (label, format_weight(weight))
+                            for label, weight in map(parse_item, batch))
+                    else:
+                        f.write('\n'.join(batch) + '\n')
+                    yield (start + len(batch)) / len(items)
+                f.flush()
+                os.fsync(f.fileno())
+            keep_mode(fname, tmp_name)
+            os.replace(tmp_name, fname)
+        except BaseException:
+            if os.path.exists(tmp_name):
+                os.remove(tmp_name)
+            raise
+
+    def start_transfer(self, steps, message):
+        self.transfer = steps
+        self.items_edit.setReadOnly(True)
+        self.import_action.setEnabled(False)
+        self.export_action.setEnabled(False)
+        self.select_widget.setEnabled(False)
+        self.statusBar().showMessage(message)
+        self.progress_bar.setValue(0)
+        self.progress_bar.setVisible(True)
+        self.cancel_button.setVisible(True)
+        self.transfer_timer.start()
+
+    def finish_transfer(self, message):
+        self.transfer_timer.stop()
+        self.transfer = None
+        self.items_edit.setReadOnly(False)
+        self.import_action.setEnabled(True)
+        self.progress_bar.setVisible(False)
+        self.cancel_button.setVisible(False)
+        self.statusBar().showMessage(message, 5000)
+        # Restore the actions and Select tab for the current items.
+        self.items_timer.stop()
+        self.items_changed = True
+        self.on_items()
+
+    @pyqtSlot()
+    def on_transfer_step(self):
+        try:
+            progress = next(self.transfer)
+        except StopIteration:
+            self.finish_transfer('Done')
+        except (OSError, csv.Error) as e:
+            self.finish_transfer('Failed')
+            QMessageBox.warning(self, 'SpinWheel', str(e))
+        else:
+            self.progress_bar.setValue(round(progress * 100))
+
+    @pyqtSlot()
+    def on_cancel(self):
+        if self.transfer is not None:
+            self.transfer.close()
+            self.finish_transfer('Cancelled')
 
     @pyqtSlot()
     def on_about(self):
@@ -126,11 +247,14 @@ class MainWindow(QMainWindow):
         self.input_widget.setLayout(input_layout)
 
         # Add widgets.
-        items_label = QLabel('Enter items separated by newlines:', self)
+        items_label = QLabel(
+            'Enter items separated by newlines (optional tab + weight):',
+            self)
         self.items_edit = QTextEdit(self)
         self.items_edit.setFixedHeight(265)
         self.items_edit.addScrollBarWidget(QScrollBar(), Qt.AlignRight)
-        self.items_edit.textChanged.connect(self.on_items)
+        self.items_edit.document().contentsChange.connect(
+            self.on_contents_change)
         input_layout.addRow(items_label)
         input_layout.addRow(self.items_edit)
 
@@ -141,16 +265,59 @@ class MainWindow(QMainWindow):
         self.count_edit.setDisabled(True)
         input_layout.addRow(count_label, self.count_edit)
 
+        # Debounce the count and redraw so typing stays responsive.
+        self.items_timer = QTimer(self)
+        self.items_timer.setSingleShot(True)
+        self.items_timer.setInterval(150)
+        self.items_timer.timeout.connect(self.on_items)
+
+    @pyqtSlot(int, int, int)
+    def on_contents_change(self, position, removed, added):
+        """Parses only the edited lines and splices them into the items."""
+        document = self.items_edit.document()
+        first = document.findBlock(position)
+        last = document.findBlock(position + added)
+        if not last.isValid():
+            last = document.lastBlock()
+
+        # Lines first .. last hold the edit now. Whatever the block count
+        # grew or shrank by, they took the place of that many more or
+        # fewer lines before it.
+        start = first.blockNumber()
+        count = last.blockNumber() - start + 1
+        stop = start + count - (document.blockCount() - len(self.items))
+
+        lines = []
+        block = first
+        for _ in range(count):
+            lines.append(block.text())
+            block = block.next()
+
+        if self.items[start:stop] != lines:
+            labels, weights = zip(*map(parse_item, lines))
+            self.drawable += (sum(1 for weight in weights if weight > 0)
+                              - sum(1 for weight in self.weights[start:stop]
+                                    if weight > 0))
+            self.items[start:stop] = lines
+            self.labels[start:stop] = labels
+            self.weights[start:stop] = weights
+            # A spin session takes its winners out itself; see start_spin.
+            if self.removed is None:
+                self.selector.splice(start, stop, weights)
+            self.items_changed = True
+        self.items_timer.start()
+
     @pyqtSlot()
     def on_items(self):
-        self.items = self.items_edit.toPlainText().split('\n')
-        items_count = len(self.items)
+        if not self.items_changed:
+            return
+        self.items_changed = False
 
-        if self.items != [''] and items_count > 0:
+        if self.items != ['']:
             self.export_action.setEnabled(True)
-            self.select_widget.setEnabled(True)
-            self.count_edit.setText(str(items_count))
-            self.nspin_spinbox.setRange(1, items_count)
+            self.select_widget.setEnabled(self.drawable > 0)
+            self.count_edit.setText(str(len(self.items)))
+            self.nspin_spinbox.setRange(1, max(self.drawable, 1))
             self.plot_spinwheel()
         else:
             self.export_action.setEnabled(False)
@@ -158,30 +325,14 @@ class MainWindow(QMainWindow):
             self.count_edit.setText('0')
 
     def plot_spinwheel(self):
-        items_count = len(self.items)
-        if self.items != [''] and items_count > 0:
-            n_items = len(self.items)
-            angle = 360 / n_items
-            y = np.repeat(angle, repeats=n_items)
-
-            plt.clf()
-            plt.pie(y, labels=self.items, labeldistance=0.5, rotatelabels=45,
-                    startangle=90 - angle / 2)
-            plt.savefig('resources/spinwheel.svg', transparent=True,
-                        bbox_inches='tight', pad_inches=0)
-
-            self.wheel_pixmap = QPixmap('resources/spinwheel.svg').scaled(
-                QSize(300, 300), Qt.KeepAspectRatio,
-                Qt.SmoothTransformation)
-            self.wheel_label.setPixmap(self.wheel_pixmap)
-            self.wheel_label.repaint()
-
-            self.angle = angle
+        if self.items != [''] and self.drawable > 0:
+            self.wheel_pixmap = self.wheel_renderer.render(
+                self.labels, self.weights)
+            self.wheel_widget.setPixmap(self.wheel_pixmap)
         else:
             self.wheel_pixmap = QPixmap(
                 resource_path('resources/default_wheel.png'))
-            self.wheel_label.setPixmap(self.wheel_pixmap)
-            self.wheel_label.repaint()
+            self.wheel_widget.setPixmap(self.wheel_pixmap)
 
     def add_select_subwidgets(self):
         # Set layout.
@@ -210,76 +361,885 @@ class MainWindow(QMainWindow):
         pointer_label.setPixmap(pointer_pixmap)
         select_layout.addWidget(pointer_label)
 
-        self.wheel_label = QLabel(self)
+        self.wheel_widget = WheelWidget(self.wheel_renderer.size, self)
         self.plot_spinwheel()
         wheel_layout = QHBoxLayout(self)
         wheel_layout.setAlignment(Qt.AlignCenter)
-        wheel_layout.addWidget(self.wheel_label)
+        wheel_layout.addWidget(self.wheel_widget)
         select_layout.addLayout(wheel_layout)
 
-        spin_button = QPushButton('Spin', self)
-        spin_button.setFixedWidth(80)
-        spin_button.clicked.connect(self.on_spin)
+        self.spin_button = QPushButton('Spin', self)
+        self.spin_button.setFixedWidth(80)
+        self.spin_button.clicked.connect(self.on_spin)
         spin_button_layout = QHBoxLayout(self)
         spin_button_layout.setAlignment(Qt.AlignCenter)
-        spin_button_layout.addWidget(spin_button)
+        spin_button_layout.addWidget(self.spin_button)
         select_layout.addLayout(spin_button_layout)
 
-    def on_spin(self):
-        self.winner = Selector.random_select(self.items)
-        deg_winner = self.items.index(self.winner) * self.angle
+        # Animate on the event loop; frames follow Qt's 60 Hz animation timer.
+        self.spin_animation = QVariantAnimation(self)
+        self.spin_animation.setDuration(3000)
+        self.spin_animation.setEasingCurve(QEasingCurve.OutCubic)
+        self.spin_animation.valueChanged.connect(self.wheel_widget.setAngle)
+        self.spin_animation.finished.connect(self.on_spin_finished)
 
-        secs = 3
-        deg_step = 10
-        frames = secs * deg_step
+        # Count down between spins of a multi-spin session.
+        self.countdown_timer = QTimer(self)
+        self.countdown_timer.setInterval(1000)
+        self.countdown_timer.timeout.connect(self.on_countdown)
 
-        deg = 0
-        for i in range(frames):
-            self.wheel_label.setPixmap(self.wheel_pixmap.transformed(
-                QTransform().rotate(deg), mode=Qt.SmoothTransformation))
-            self.wheel_label.setAlignment(Qt.AlignCenter)
-            self.wheel_label.repaint()
+    @pyqtSlot()
+    def on_spin(self):
+        if self.spinning:
+            self.cancel_spin()
+        else:
+            self.removed = []
+            self.set_spinning(True)
+            self.start_spin()
 
-            deg = (deg + deg_step) % 360
-            time.sleep(secs / frames)
+    def start_spin(self):
+        # Apply any edit still waiting on the debounce timer.
+        self.items_timer.stop()
+        self.on_items()
 
-        while(True):
-            if abs(deg_winner - deg) > deg_step:
-                deg = (deg + deg_step) % 360
+        # Winners are drawn without replacement. The Selector keeps a slot
+        # for each winner removed this session, so count those off.
+        self.slot = self.selector.pop()
+        self.winner = self.slot - bisect.bisect_left(self.removed, self.slot)
+        start, end = spin_angles(
+            self.wheel_widget.angle(), WheelRenderer.segments(self.weights),
+            self.winner)
+        self.spin_animation.setStartValue(start)
+        self.spin_animation.setEndValue(end)
+        self.spin_animation.start()
 
-                self.wheel_label.setPixmap(self.wheel_pixmap.transformed(
-                QTransform().rotate(deg), mode=Qt.SmoothTransformation))
-                self.wheel_label.setAlignment(Qt.AlignCenter)
-                self.wheel_label.repaint()
+    def cancel_spin(self):
+        if self.countdown_timer.isActive():
+            print()
+        self.spin_animation.stop()
+        self.countdown_timer.stop()
+        self.set_spinning(False)
+        self.statusBar().showMessage('Spin cancelled', 2000)
 
-                time.sleep(secs / frames)
-            else:
-                break
+    def set_spinning(self, spinning):
+        self.spinning = spinning
+        self.spin_button.setText('Stop' if spinning else 'Spin')
+        self.input_widget.setEnabled(not spinning)
+        self.import_action.setEnabled(not spinning)
+        self.nspin_spinbox.setEnabled(not spinning)
+        if not spinning:
+            self.end_session()
 
-        print(f'Winner: {self.winner}')
+    def end_session(self):
+        """Brings the Selector back in step with the items."""
+        if self.removed:
+            # The removed winners shifted the lines after them.
+            self.selector = Selector(self.weights)
+        elif self.slot is not None:
+            # The last winner is still on the list; put it back.
+            self.selector.splice(
+                self.slot, self.slot + 1, [self.weights[self.winner]])
+        self.slot = None
+        self.removed = None
+
+    @pyqtSlot()
+    def on_spin_finished(self):
+        label = self.labels[self.winner]
+        print(f'Winner: {label}')
+        self.statusBar().showMessage(f'Winner: {label}')
 
         if self.nspin_spinbox.value() > 1:
-            print('Re-spinning in', end=' ')
-            for i in range(3, 0, -1):
-                print(i, end=' ')
-                time.sleep(1)
-            print()
-            self.items.remove(self.winner)
-            self.items_edit.setText('\n'.join(self.items))
-            self.nspin_spinbox.setValue(self.nspin_spinbox.value() - 1)
+            print('Re-spinning in', end=' ', flush=True)
+            self.countdown = 3
+            self.on_countdown()
+            self.countdown_timer.start()
+        else:
+            self.set_spinning(False)
 
-            self.on_spin()
+    @pyqtSlot()
+    def on_countdown(self):
+        if self.countdown > 0:
+            print(self.countdown, end=' ', flush=True)
+            self.statusBar().showMessage(
+                f'Winner: {self.labels[self.winner]}. '
+                f'Re-spinning in {self.countdown}...')
+            self.countdown -= 1
+            return
+
+        self.countdown_timer.stop()
+        print()
+        self.remove_winner()
+        self.nspin_spinbox.setValue(self.nspin_spinbox.value() - 1)
+        self.start_spin()
+
+    def remove_winner(self):
+        """Deletes the winner's block alone, so only one line changes."""
+        bisect.insort(self.removed, self.slot)
+        self.slot = None
+        block = self.items_edit.document().findBlockByNumber(self.winner)
+        cursor = QTextCursor(block)
+        if block.next().isValid():
+            cursor.setPosition(block.next().position(), QTextCursor.KeepAnchor)
+        else:
+            # The last line takes the line break before it along.
+            cursor.movePosition(QTextCursor.EndOfBlock)
+            cursor.setPosition(
+                max(block.position() - 1, 0), QTextCursor.KeepAnchor)
+        cursor.removeSelectedText()
 
     def add_statusbar(self):
-        self.statusBar()
+        self.setStatusBar(QStatusBar())
+
+        # Add progress bar and Cancel button for imports and exports.
+        self.progress_bar = QProgressBar()
+        self.progress_bar.setFixedWidth(120)
+        self.progress_bar.setRange(0, 100)
+        self.progress_bar.setVisible(False)
+        self.statusBar().addPermanentWidget(self.progress_bar)
+
+        self.cancel_button = QPushButton('Cancel')
+        self.cancel_button.setStatusTip('Cancel the running import or export')
+        self.cancel_button.clicked.connect(self.on_cancel)
+        self.cancel_button.setVisible(False)
+        self.statusBar().addPermanentWidget(self.cancel_button)
+
+        # Run transfers a chunk per event loop turn.
+        self.transfer = None
+        self.transfer_timer = QTimer(self)
+        self.transfer_timer.timeout.connect(self.on_transfer_step)
+
+
+class WheelWidget(QWidget):
+    """Shows the wheel pixmap, rotated by the painter at draw time.
+
+    Each animation frame is a single transformed blit of the cached
+    pixmap; nothing is resampled or allocated per frame.
+    """
+
+    def __init__(self, size, parent=None):
+        super(WheelWidget, self).__init__(parent)
+        self.setFixedSize(size)
+        self._pixmap = QPixmap()
+        self._angle = 0.0
+
+    def pixmap(self):
+        return self._pixmap
+
+    def setPixmap(self, pixmap):
+        self._pixmap = pixmap
+        self.update()
+
+    def angle(self):
+        return self._angle
+
+    @pyqtSlot('QVariant')
+    def setAngle(self, angle):
+        self._angle = angle
+        self.update()
+
+    def paintEvent(self, event):
+        if self._pixmap.isNull():
+            return
+        painter = QPainter(self)
+        painter.setRenderHint(QPainter.SmoothPixmapTransform)
+        painter.translate(self.width() / 2, self.height() / 2)
+        painter.rotate(self._angle)
+        painter.drawPixmap(
+            QPointF(-self._pixmap.width() / 2, -self._pixmap.height() / 2),
+            self._pixmap)
+
+
+class WheelRenderer:
+    """Draws the wheel natively with QPainter into a cached pixmap.
+
+    Segments run counter-clockwise with the first item centred at the top,
+    under the pointer, and span an angle proportional to their weight. The
+    pixmap for the last item list is cached, so redrawing an unchanged
+    wheel is free.
+
+    Detail is levelled to what can be seen: fills are batched by colour,
+    runs of segments thinner than a pixel merge into one blended wedge, and
+    only labels that fit their segment are laid out, through a cache.
+    """
+
+    COLORS = ('#1f77b4', '#ff7f0e', '#2ca02c', '#d62728', '#9467bd',
+              '#8c564b', '#e377c2', '#7f7f7f', '#bcbd22', '#17becf')
+    MIN_SEGMENT = 0.75  # Pixels at the rim.
+    MAX_LABELS = 4096
+
+    def __init__(self, size):
+        self.size = size
+        self._key = None
+        self._pixmap = None
+        self._labels = {}
+        colors = [QColor(color) for color in self.COLORS]
+        self._blend = QColor(
+            *(round(sum(channel) / len(colors)) for channel in zip(
+                *(color.getRgb()[:3] for color in colors))))
+
+    @staticmethod
+    def segments(weights):
+        """Returns (start, span) in degrees, counter-clockwise, per item."""
+        total = sum(weights)
+        spans = [360 * weight / total for weight in weights]
+        start = 90 - spans[0] / 2
+        segments = []
+        for span in spans:
+            segments.append((start, span))
+            start += span
+        return segments
+
+    def render(self, items, weights=None):
+        if weights is None:
+            weights = [1] * len(items)
+        key = (tuple(items), tuple(weights))
+        if key != self._key:
+            self._pixmap = self.draw(items, weights)
+            self._key = key
+        return self._pixmap
+
+    def draw(self, items, weights):
+        pixmap = QPixmap(self.size)
+        pixmap.fill(Qt.transparent)
+        painter = QPainter(pixmap)
+        painter.setRenderHint(QPainter.Antialiasing)
+        painter.setRenderHint(QPainter.TextAntialiasing)
+
+        rect = QRectF(pixmap.rect()).adjusted(1, 1, -1, -1)
+        segments = self.segments(weights)
+        self.draw_segments(painter, rect, segments)
+        self.draw_labels(painter, rect, items, segments)
+
+        painter.end()
+        return pixmap
+
+    def draw_segments(self, painter, rect, segments):
+        # Group wedges by colour so the brush changes once per colour.
+        min_span = self.MIN_SEGMENT * 360 / (math.pi * rect.width())
+        wedges = [[] for _ in self.COLORS]
+        blend = []
+        run = None
+        for i, (start, span) in enumerate(segments):
+            if span >= min_span:
+                if run is not None:
+                    blend.append((run, start - run))
+                    run = None
+                wedges[i % len(wedges)].append((start, span))
+            elif span > 0 and run is None:
+                run = start
+        if run is not None:
+            start, span = segments[-1]
+            blend.append((run, start + span - run))
+
+        # QPainter angles are counter-clockwise in 1/16°.
+        painter.setPen(Qt.NoPen)
+        for color, group in zip(
+                [QColor(color) for color in self.COLORS] + [self._blend],
+                wedges + [blend]):
+            painter.setBrush(color)
+            for start, span in group:
+                painter.drawPie(rect, round(start * 16), round(span * 16))
+
+    def draw_labels(self, painter, rect, items, segments):
+        # Labels run along the radius and end at the rim, where segments
+        # are widest; those whose segment is too thin there are culled.
+        painter.setPen(QPen(Qt.black))
+        metrics = QFontMetrics(painter.font())
+        height = metrics.height()
+        # Neighbouring labels may share their leading and descent.
+        thickness = metrics.ascent()
+        radius = rect.width() / 2
+        inner, outer = radius * 0.3, radius * 0.95
+        min_width = metrics.horizontalAdvance('W\u2026')
+        min_span = math.degrees(thickness / (outer - min_width))
+
+        for item, (start, span) in zip(items, segments):
+            if span < min_span:
+                continue
+            # The segment is as wide as a line of text from this radius out.
+            fit = thickness / math.radians(min(span, 180))
+            width = outer - max(inner, fit)
+            if width < min_width:
+                continue
+            label = self.label(painter.font(), item, int(width))
+            if label is None:
+                continue
+
+            mid = start + span / 2
+            painter.save()
+            painter.translate(rect.center())
+            painter.rotate(-mid)
+            if 90 < mid % 360 < 270:
+                # Keep text on the left half upright.
+                painter.rotate(180)
+                painter.drawStaticText(QPointF(-outer, -height / 2), label)
+            else:
+                painter.drawStaticText(
+                    QPointF(outer - label.size().width(), -height / 2),
+                    label)
+            painter.restore()
+
+    def label(self, font, item, width):
+        """Returns the cached layout of item elided to width, if legible."""
+        key = (item, width)
+        if key not in self._labels:
+            if len(self._labels) >= self.MAX_LABELS:
+                self._labels.clear()
+            text = QFontMetrics(font).elidedText(item, Qt.ElideRight, width)
+            label = None
+            if text.strip() and text != '\u2026':
+                label = QStaticText(text)
+                label.setTextFormat(Qt.PlainText)
+                label.prepare(font=font)
+            self._labels[key] = label
+        return self._labels[key]
 
 
 class Selector:
+    """Draws item indices by weight from a seedable, reproducible RNG.
+
+    Draws with replacement sample a Vose alias table in O(1). Draws
+    without replacement take the winner out of a Fenwick tree over the
+    weights, so k draws from n items cost O(n + k log n).
+    """
+
+    def __init__(self, weights, seed=None):
+        self.weights = self.check(weights)
+        if seed is None:
+            seed = random.SystemRandom().getrandbits(64)
+        self.seed = seed
+        self.random = random.Random(seed)
+        self._alias = None
+        self._tree = None
+
+    def __len__(self):
+        """Returns the number of items that can still be drawn."""
+        return sum(1 for weight in self.weights if weight > 0)
+
+    def choice(self):
+        """Draws one index with replacement."""
+        if self._alias is None:
+            self._alias = self.build_alias(self.weights)
+        prob, alias = self._alias
+        i = self.random.randrange(len(prob))
+        return i if self.random.random() < prob[i] else alias[i]
+
+    def pop(self):
+        """Draws one index without replacement."""
+        if self._tree is None:
+            self._tree = self.build_tree(self.weights)
+        tree = self._tree
+        n = len(self.weights)
+        step = 1 << n.bit_length()
+
+        while True:
+            total = self.prefix_sum(n)
+            if total <= 0:
+                raise ValueError('no items with positive weight left')
+            # Find the first index whose prefix sum exceeds the target.
+            target = self.random.random() * total
+            i = 0
+            bit = step
+            while bit:
+                if i + bit <= n and tree[i + bit] <= target:
+                    i += bit
+                    target -= tree[i]
+                bit >>= 1
+            # Rounding can land past the end or on a drawn item; redraw.
+            if i < n and self.weights[i] > 0:
+                break
+
+        self.adjust(i, -self.weights[i])
+        self.weights[i] = 0.0
+        self._alias = None
+        return i
+
+    def splice(self, start, stop, weights):
+        """Replaces the weights of items start .. stop - 1 with weights.
+
+        When the number of items stays the same, the Fenwick tree is
+        updated in O(log n) per weight; otherwise it is rebuilt by the
+        next pop().
+        """
+        weights = self.check(weights)
+        if self._tree is not None and len(weights) == stop - start:
+            for i, weight in enumerate(weights, start):
+                self.adjust(i, weight - self.weights[i])
+        else:
+            self._tree = None
+        self.weights[start:stop] = weights
+        self._alias = None
+
+    def adjust(self, i, delta):
+        """Adds delta to the weight of item i in the Fenwick tree."""
+        tree = self._tree
+        j = i + 1
+        while j < len(tree):
+            tree[j] += delta
+            j += j & -j
+
+    def sample(self, k, replace=False):
+        """Draws k indices, with or without replacement."""
+        if replace:
+            return [self.choice() for _ in range(k)]
+        if k > len(self):
+            raise ValueError(f'cannot draw {k} of {len(self)} items')
+        return [self.pop() for _ in range(k)]
+
+    def stream(self, entries, k, replace=False):
+        """Draws k entries from an iterable of (weight, entry) pairs.
+
+        Only the k picks are held in memory: without replacement this is
+        weighted reservoir sampling (A-Res), with replacement each pick is
+        a reservoir of one. The picks come back in draw order.
+        """
+        if replace:
+            picks = [None] * k
+            total = 0.0
+            for weight, entry in entries:
+                if weight <= 0:
+                    continue
+                total += weight
+                p = weight / total
+                if p >= 1:
+                    picks = [entry] * k
+                    continue
+                # Each pick is replaced with probability p; jump straight
+                # to the next replaced one with a geometric skip, so an
+                # entry costs O(1 + picks replaced) rather than O(k).
+                log_q = math.log1p(-p)
+                i = -1
+                while True:
+                    skip = math.log(1.0 - self.random.random()) / log_q
+                    if i + 1 + skip >= k:
+                        break
+                    i += 1 + int(skip)
+                    picks[i] = entry
+            if total <= 0 and k:
+                raise ValueError('no items with positive weight')
+            return picks
+
+        # Keep the k largest keys u ** (1 / w), compared as logarithms.
+        heap = []
+        for seq, (weight, entry) in enumerate(entries):
+            if weight <= 0:
+                continue
+            key = math.log(1.0 - self.random.random()) / weight
+            if len(heap) < k:
+                heapq.heappush(heap, (key, seq, entry))
+            elif key > heap[0][0]:
+                heapq.heapreplace(heap, (key, seq, entry))
+        if len(heap) < k:
+            raise ValueError(f'cannot draw {k} of {len(heap)} items')
+        return [entry for _, _, entry in sorted(heap, reverse=True)]
+
+    def prefix_sum(self, n):
+        total = 0.0
+        while n:
+            total += self._tree[n]
+            n -= n & -n
+        return total
+
+    @staticmethod
+    def check(weights):
+        """Returns weights as floats; raises ValueError for bad ones."""
+        weights = [float(weight) for weight in weights]
+        if any(not math.isfinite(weight) or weight < 0 for weight in weights):
+            raise ValueError('weights must be finite and non-negative')
+        return weights
+
+    @staticmethod
+    def build_alias(weights):
+        """Builds Vose's alias table for the given weights in O(n)."""
+        n = len(weights)
+        total = sum(weights)
+        if total <= 0:
+            raise ValueError('no items with positive weight left')
+        scaled = [weight * n / total for weight in weights]
+        small = [i for i, p in enumerate(scaled) if p < 1]
+        large = [i for i, p in enumerate(scaled) if p >= 1]
+        prob = [1.0] * n
+        alias = list(range(n))
+        while small and large:
+            s, l = small.pop(), large.pop()
+            prob[s], alias[s] = scaled[s], l
+            scaled[l] += scaled[s] - 1
+            (small if scaled[l] < 1 else large).append(l)
+        # Leftovers are 1 up to rounding.
+        return prob, alias
+
     @staticmethod
-    def random_select(items: list):
-        if not isinstance(items, list):
-            raise ValueError(f'items={items} must be a list of strings!')
-        return random.choice(items)
+    def build_tree(weights):
+        """Builds a 1-based Fenwick tree over the weights in O(n)."""
+        n = len(weights)
+        tree = [0.0] + list(weights)
+        for i in range(1, n + 1):
+            j = i + (i & -i)
+            if j <= n:
+                tree[j] += tree[i]
+        return tree
+
+
+def parse_item(line):
+    """Splits an optional tab-separated weight off an item line."""
+    label, sep, weight = line.rpartition('\t')
+    if sep:
+        try:
+            weight = float(weight)
+        except ValueError:
+            pass
+        else:
+            if math.isfinite(weight) and weight >= 0:
+                return label, weight
+    return line, 1.0
+
+
+def spin_angles(angle, segments, index, turns=2):
+    """Returns start and end angles for a spin that stops on index.
+
+    The wheel turns clockwise from angle, a few full turns and on until
+    the middle of the segment is under the pointer at the top.
+    """
+    start, span = segments[index]
+    landing = start + span / 2 - 90
+    start = float(angle % 360)
+    return start, start + turns * 360 + (landing - start) % 360
+
+
+def segment_at(starts, angle):
+    """Returns the index of the segment under the pointer.
+
+    starts holds the segments' start angles in order, as given by
+    WheelRenderer.segments, and angle is the wheel's clockwise turn.
+    """
+    pointer = starts[0] + (90 + angle - starts[0]) % 360
+    return bisect.bisect_right(starts, pointer) - 1
+
+
+class FirstPaintReporter(QObject):
+    """Prints the time to the window's first paint, then quits."""
+
+    def __init__(self, window, started):
+        super(FirstPaintReporter, self).__init__(window)
+        self.started = started
+        window.installEventFilter(self)
+
+    def eventFilter(self, obj, event):
+        if event.type() == QEvent.Paint:
+            obj.removeEventFilter(self)
+            # Let the paint finish before stopping the clock.
+            QTimer.singleShot(0, self.report)
+        return False
+
+    def report(self):
+        elapsed = (time.perf_counter() - self.started) * 1000
+        print(f'first_paint_ms={elapsed:.1f}', flush=True)
+        QApplication.quit()
+
+
+def startup_benchmark(argv):
+    """Measures cold start: interpreter and imports, then first paint."""
+    parser = argparse.ArgumentParser(
+        prog='spinwheel.py benchmark-startup',
+        description='Measure SpinWheel start-up time.')
+    parser.add_argument(
+        '-n', '--runs', type=int, default=5, help='runs (default: 5)')
+    parser.add_argument(
+        '--max-ms', type=float,
+        help='fail if the median time to first paint exceeds this')
+    args = parser.parse_args(argv)
+
+    totals, windows = [], []
+    for _ in range(args.runs):
+        start = time.perf_counter()
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--first-paint'],
+            capture_output=True, text=True, check=True).stdout
+        total = (time.perf_counter() - start) * 1000
+        window = float(output.split('first_paint_ms=')[1].split()[0])
+        totals.append(total)
+        windows.append(window)
+
+    total = statistics.median(totals)
+    window = statistics.median(windows)
+    print(f'startup (median of {args.runs}): {total:.1f} ms total, '
+          f'{total - window:.1f} ms interpreter and imports, '
+          f'{window:.1f} ms window to first paint')
+    if args.max_ms is not None and total > args.max_ms:
+        print(f'startup exceeds {args.max_ms:.1f} ms', file=sys.stderr)
+        return 1
+    return 0
+
+
+class FrameTimer(QObject):
+    """Records the time of each paint of a widget."""
+
+    def __init__(self, widget):
+        super(FrameTimer, self).__init__(widget)
+        self.times = []
+        widget.installEventFilter(self)
+
+    def eventFilter(self, obj, event):
+        if event.type() == QEvent.Paint:
+            self.times.append(time.perf_counter())
+        return False
+
+
+def benchmark(argv):
+    """Measures selection speed and fairness, landing and frame times."""
+    parser = argparse.ArgumentParser(
+        prog='spinwheel.py benchmark',
+        description='Benchmark SpinWheel selection and spin animation.')
+    parser.add_argument(
+        '-n', '--items', type=int, default=1000,
+        help='items on the wheel (default: 1000)')
+    parser.add_argument(
+        '-d', '--draws', type=int, default=1000000,
+        help='draws for throughput and chi-square (default: 1000000)')
+    parser.add_argument(
+        '-w', '--weighted', action='store_true',
+        help='use random weights from 1 to 10 (default: all equal)')
+    parser.add_argument(
+        '-s', '--seed', type=int, default=0, help='seed (default: 0)')
+    parser.add_argument(
+        '--spins', type=int, default=3,
+        help='animated spins to time; 0 skips the GUI (default: 3)')
+    args = parser.parse_args(argv)
+
+    rng = random.Random(args.seed)
+    n = args.items
+    weights = [rng.randint(1, 10) if args.weighted else 1 for _ in range(n)]
+    total = sum(weights)
+
+    # Throughput, with and without replacement.
+    start = time.perf_counter()
+    selector = Selector(weights, args.seed)
+    selector.choice()
+    build = time.perf_counter() - start
+    start = time.perf_counter()
+    picks = [selector.choice() for _ in range(args.draws)]
+    elapsed = time.perf_counter() - start
+    print(f'alias table: {build * 1000:.1f} ms for {n} items, '
+          f'{args.draws / elapsed:,.0f} draws/s')
+    k = min(n, args.draws)
+    start = time.perf_counter()
+    Selector(weights, args.seed).sample(k)
+    elapsed = time.perf_counter() - start
+    print(f'without replacement: {k} of {n} in {elapsed * 1000:.1f} ms, '
+          f'{k / elapsed:,.0f} draws/s')
+
+    # Pearson's chi-square against the weights, with the Wilson-Hilferty
+    # approximation for its p-value.
+    counts = [0] * n
+    for i in picks:
+        counts[i] += 1
+    chi2 = sum((count - args.draws * weight / total) ** 2
+               / (args.draws * weight / total)
+               for count, weight in zip(counts, weights))
+    df = max(n - 1, 1)
+    z = ((chi2 / df) ** (1 / 3) - (1 - 2 / (9 * df))) / math.sqrt(2 / (9 * df))
+    p = math.erfc(z / math.sqrt(2)) / 2
+    print(f'chi-square: {chi2:.1f} on {df} df, p = {p:.3f}')
+
+    # Every item must land under the pointer from any starting angle.
+    segments = WheelRenderer.segments(weights)
+    starts = [start for start, _ in segments]
+    misses = 0
+    for i in range(n):
+        _, end = spin_angles(rng.uniform(0, 360), segments, i)
+        misses += segment_at(starts, end) != i
+    print(f'landing: {n - misses} of {n} items land under the pointer')
+
+    if args.spins > 0:
+        frames = frame_times(
+            [f'item {i}\t{weight}' for i, weight in enumerate(weights)],
+            args.spins)
+        frames.sort()
+        print(f'frames: {len(frames)}, '
+              f'p50 {frames[len(frames) // 2]:.1f} ms, '
+              f'p95 {frames[len(frames) * 95 // 100]:.1f} ms, '
+              f'max {frames[-1]:.1f} ms')
+        edges = (8, 17, 25, 34, 50)
+        for low, high in zip((0,) + edges, edges + (math.inf,)):
+            count = sum(1 for frame in frames if low <= frame < high)
+            print(f'  {low:>3}-{high:<3} ms {count:>6} '
+                  f'{"#" * round(60 * count / len(frames))}')
+
+    return 1 if misses else 0
+
+
+def frame_times(items, spins):
+    """Runs spins on a SpinWheel window; returns frame times in ms."""
+    app = QApplication.instance() or QApplication(sys.argv[:1])
+    window = MainWindow()
+    window.items_edit.setPlainText('\n'.join(items))
+    window.centralWidget().setCurrentWidget(window.select_widget)
+    window.nspin_spinbox.setValue(1)
+    timer = FrameTimer(window.wheel_widget)
+
+    frames = []
+    for _ in range(spins):
+        timer.times = []
+        window.spin_animation.finished.connect(app.quit)
+        window.on_spin()
+        app.exec_()
+        window.spin_animation.finished.disconnect(app.quit)
+        frames.extend((b - a) * 1000 for a, b in zip(
+            timer.times, timer.times[1:]))
+    window.close()
+    return frames
+
+
+BOMS = (
+    (codecs.BOM_UTF32_LE, 'utf-32'), (codecs.BOM_UTF32_BE, 'utf-32'),
+    (codecs.BOM_UTF8, 'utf-8-sig'), (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'))
+
+
+def open_text(fname):
+    """Opens fname for reading text in whatever encoding it has.
+
+    A BOM selects UTF-8, UTF-16 or UTF-32; otherwise the file is read as
+    UTF-8 unless its start does not decode, in which case cp1252 is used.
+    Any newline style reads as a plain newline.
+    """
+    with open(fname, 'rb') as f:
+        head = f.read(1 << 16)
+    for bom, encoding in BOMS:
+        if head.startswith(bom):
+            break
+    else:
+        encoding = 'utf-8'
+        try:
+            head.decode('utf-8')
+        except UnicodeDecodeError as e:
+            # Allow a multi-byte character cut off at the end of head.
+            if e.start < len(head) - 3:
+                encoding = 'cp1252'
+    return open(fname, encoding=encoding, errors='replace', newline=None)
+
+
+# Written by export; a first row matching it is not an item.
+CSV_HEADER = ('label', 'weight')
+
+
+def iter_item_chunks(f, csv_format, size=1 << 16):
+    """Yields the text of item lines from f in chunks of about size."""
+    if not csv_format:
+        for chunk in iter(lambda: f.read(size), ''):
+            yield chunk
+        return
+
+    lines, length = [], 0
+    for number, row in enumerate(csv.reader(f)):
+        if number == 0 and [cell.strip().lower() for cell in row] == list(
+                CSV_HEADER):
+            continue
+        label = row[0] if row else ''
+        label = label.translate({ord(c): ' ' for c in '\t\r\n'})
+        weight = row[1].strip() if len(row) > 1 else ''
+        try:
+            weight = format_weight(float(weight)) if weight else ''
+        except ValueError:
+            weight = ''
+        line = f'{label}\t{weight}' if weight else label
+        lines.append(line)
+        length += len(line) + 1
+        if length >= size:
+            yield '\n'.join(lines) + '\n'
+            lines, length = [], 0
+    if lines:
+        yield '\n'.join(lines) + '\n'
+
+
+def is_csv(fname):
+    return fname.lower().endswith('.csv')
+
+
+def format_weight(weight):
+    return str(int(weight)) if weight.is_integer() else repr(weight)
+
+
+def read_entries(f, weighted):
+    """Yields (weight, (line number, label)) for the non-blank lines of f."""
+    for number, line in enumerate(f, 1):
+        line = line.rstrip('\r\n')
+        if not line.strip():
+            continue
+        label, weight = parse_item(line)
+        yield (weight if weighted else 1.0), (number, label)
+
+
+def draw_main(argv):
+    """Draws winners from a list of entries without the GUI."""
+    parser = argparse.ArgumentParser(
+        prog='spinwheel.py draw',
+        description='Draw winners from a file of entries, one per line. '
+                    'A line may end in a tab and a weight.')
+    parser.add_argument(
+        'source', nargs='?', default='-',
+        help='entries file (default: - for stdin)')
+    parser.add_argument(
+        '-n', '--winners', type=int, default=1,
+        help='number of winners (default: 1)')
+    parser.add_argument(
+        '-w', '--weighted', action='store_true',
+        help='use the per-line weights (default: all equal)')
+    parser.add_argument(
+        '-r', '--replace', action='store_true',
+        help='draw with replacement; an entry may win more than once')
+    parser.add_argument(
+        '-s', '--seed', type=int,
+        help='seed to replay a draw (default: random, written to output)')
+    parser.add_argument(
+        '--stream', action='store_true',
+        help='reservoir-sample in one pass; memory grows with winners only')
+    parser.add_argument(
+        '-o', '--output', default='-',
+        help='results file (default: - for stdout)')
+    args = parser.parse_args(argv)
+    if args.winners < 0:
+        parser.error('--winners must not be negative')
+
+    if args.source == '-':
+        source = sys.stdin
+    else:
+        try:
+            source = open_text(args.source)
+        except OSError as e:
+            parser.error(str(e))
+
+    with source:
+        entries = read_entries(source, args.weighted)
+        try:
+            if args.stream:
+                selector = Selector([], args.seed)
+                winners = selector.stream(
+                    entries, args.winners, args.replace)
+            else:
+                entries = list(entries)
+                selector = Selector(
+                    [weight for weight, _ in entries], args.seed)
+                winners = [entries[i][1] for i in selector.sample(
+                    args.winners, args.replace)]
+        except ValueError as e:
+            parser.error(str(e))
+
+    try:
+        output = sys.stdout if args.output == '-' else open(
+            args.output, 'w', encoding='utf-8')
+    except OSError as e:
+        parser.error(str(e))
+    with output:
+        # The header records everything needed to replay the draw.
+        output.write(
+            f'# spinwheel draw source={args.source} seed={selector.seed} '
+            f'winners={args.winners} weighted={args.weighted} '
+            f'replace={args.replace} stream={args.stream}\n')
+        output.write('rank\tline\tlabel\n')
+        for rank, (number, label) in enumerate(winners, 1):
+            output.write(f'{rank}\t{number}\t{label}\n')
+    return 0
 
 
 def resource_path(relative_path):
@@ -290,6 +1250,16 @@ def resource_path(relative_path):
 
 
 if __name__ == '__main__':
+    if sys.argv[1:2] == ['benchmark-startup']:
+        sys.exit(startup_benchmark(sys.argv[2:]))
+    if sys.argv[1:2] == ['benchmark']:
+        sys.exit(benchmark(sys.argv[2:]))
+    if sys.argv[1:2] == ['draw']:
+        sys.exit(draw_main(sys.argv[2:]))
+
+    started = time.perf_counter()
     app = QApplication(sys.argv)
     window = MainWindow()
+    if '--first-paint' in sys.argv:
+        FirstPaintReporter(window, started)
     sys.exit(app.exec_())
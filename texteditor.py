@@ -12,27 +12,97 @@ Sample rich text editor GUI.
 """
 
 
+import bisect
+import json
+import os
+import queue
+import re
 import sys
+import tempfile
+import threading
 
 from PyQt5.QtWidgets import (
     QApplication, QMainWindow, QMenuBar, QMenu, QAction, QMessageBox, QTextEdit,
-    QFileDialog, QInputDialog, QFontDialog, QColorDialog)
+    QFileDialog, QInputDialog, QFontDialog, QColorDialog, QDialog,
+    QDialogButtonBox, QFormLayout, QLineEdit, QCheckBox, QStatusBar,
+    QProgressBar, QPushButton, QStackedWidget)
 from PyQt5.QtGui import QIcon, QTextCursor, QColor
-from PyQt5.QtCore import Qt
+from PyQt5.QtCore import (
+    Qt, QPoint, QObject, QThreadPool, QTimer, pyqtSignal)
+
+from textfile import FileLoader, LargeFileView, Task, keep_mode
 
 
 class Window(QMainWindow):
+    # Files this big open in the paged, read-only large-file view.
+    LARGE_FILE_SIZE = 64 << 20
+    AUTOSAVE_INTERVAL = 30000
+
     def __init__(self):
         super(Window, self).__init__()
         self.setWindowTitle('Rich Text Editor')
         self.setGeometry(100, 100, 400, 500)
+        self.match_starts = []
+        self.match_ends = []
+        self.search = None
+        self.index = None
+        self.loader = None
+        self.html_parts = None
+        self.open_cursor = None
+        self.fname = None
+        self.changes = None
+        self.journal_revision = None
         self.add_central_widget()
         self.add_menubar_widget()
+        self.add_statusbar()
         self.show()
 
     def add_central_widget(self):
         self.textedit = QTextEdit()
-        self.setCentralWidget(self.textedit)
+        self.viewer = LargeFileView()
+        self.viewer.indexed.connect(self.on_indexed)
+        self.viewer.found.connect(self.on_large_found)
+        self.stack = QStackedWidget()
+        self.stack.addWidget(self.textedit)
+        self.stack.addWidget(self.viewer)
+        self.setCentralWidget(self.stack)
+
+        # Highlight only the matches in view; refresh as it scrolls.
+        self.textedit.verticalScrollBar().valueChanged.connect(
+            self.update_highlights)
+        self.textedit.horizontalScrollBar().valueChanged.connect(
+            self.update_highlights)
+        self.textedit.document().contentsChange.connect(self.on_text_change)
+
+        # Re-run the search shortly after edits when the index is on.
+        self.refresh_timer = QTimer(self)
+        self.refresh_timer.setSingleShot(True)
+        self.refresh_timer.setInterval(150)
+        self.refresh_timer.timeout.connect(self.on_refresh_matches)
+
+        # Save on a worker; journal edits to plain text files meanwhile.
+        self.saver = DocumentSaver(self)
+        self.saver.saved.connect(self.on_saved)
+        self.saver.journaled.connect(self.on_journaled)
+        self.saver.failed.connect(self.on_save_failed)
+        self.autosave_timer = QTimer(self)
+        self.autosave_timer.setInterval(self.AUTOSAVE_INTERVAL)
+        self.autosave_timer.timeout.connect(self.on_autosave)
+
+    def add_statusbar(self):
+        self.setStatusBar(QStatusBar())
+
+        # Add progress bar and Cancel button for opening files.
+        self.progress_bar = QProgressBar()
+        self.progress_bar.setFixedWidth(120)
+        self.progress_bar.setRange(0, 100)
+        self.progress_bar.setVisible(False)
+        self.statusBar().addPermanentWidget(self.progress_bar)
+
+        self.cancel_button = QPushButton('Cancel')
+        self.cancel_button.clicked.connect(self.on_cancel)
+        self.cancel_button.setVisible(False)
+        self.statusBar().addPermanentWidget(self.cancel_button)
 
     def add_menubar_widget(self):
         # Add menubar.
@@ -57,10 +127,20 @@ class Window(QMainWindow):
         file_menu.addAction(open_action)
 
         # Add Save action to File menu.
-        save_action = QAction(QIcon('resources/save_file.png'), 'Save', self)
-        save_action.setShortcut('Ctrl+S')
-        save_action.triggered.connect(self.on_save)
-        file_menu.addAction(save_action)
+        self.save_action = QAction(
+            QIcon('resources/save_file.png'), 'Save', self)
+        self.save_action.setShortcut('Ctrl+S')
+        self.save_action.triggered.connect(self.on_save)
+        file_menu.addAction(self.save_action)
+
+        # Add Autosave toggle to File menu.
+        autosave_action = QAction('Autosave', self)
+        autosave_action.setCheckable(True)
+        autosave_action.setStatusTip(
+            'Journal unsaved edits to text files every 30 seconds')
+        autosave_action.toggled.connect(self.on_autosave_toggled)
+        autosave_action.setChecked(True)
+        file_menu.addAction(autosave_action)
 
         file_menu.addSeparator()
 
@@ -113,27 +193,199 @@ class Window(QMainWindow):
         find_action.triggered.connect(self.on_find)
         edit_menu.addAction(find_action)
 
+        # Add Find Next action to Edit menu.
+        find_next_action = QAction('Find Next', self)
+        find_next_action.setShortcut('F3')
+        find_next_action.triggered.connect(self.on_find_next)
+        edit_menu.addAction(find_next_action)
+
+        # Add Go to Line action to Edit menu.
+        goto_action = QAction('Go to Line', self)
+        goto_action.setShortcut('Ctrl+G')
+        goto_action.triggered.connect(self.on_goto_line)
+        edit_menu.addAction(goto_action)
+
+        # Add Search Index toggle to Edit menu.
+        self.index_action = QAction('Search Index', self)
+        self.index_action.setCheckable(True)
+        self.index_action.setStatusTip(
+            'Keep a background index so repeated searches are instant')
+        self.index_action.toggled.connect(self.on_index)
+        edit_menu.addAction(self.index_action)
+
     def on_find(self):
-        token, ok = QInputDialog.getText(self, 'Find Text', 'Find:')
-        extra_selections = []
+        dialog = FindDialog(self)
+        if dialog.exec_() != QDialog.Accepted or not dialog.text():
+            return
 
-        if ok and not self.textedit.isReadOnly():
-            self.textedit.moveCursor(QTextCursor.Start)
-            color = QColor(Qt.yellow)
+        try:
+            pattern = dialog.pattern()
+        except re.error as e:
+            QMessageBox.warning(
+                self, 'Warning', f'Invalid pattern: {e}', QMessageBox.Ok)
+            return
+
+        if self.is_large():
+            try:
+                self.viewer.find(bytes_pattern(pattern))
+            except re.error as e:
+                QMessageBox.warning(
+                    self, 'Warning', f'Invalid pattern: {e}', QMessageBox.Ok)
+            else:
+                self.statusBar().showMessage('Searching...')
+            return
+
+        # Find every match at once; the cursor stays where it is.
+        self.search = pattern, dialog.literals()
+        self.on_refresh_matches()
+
+    def on_find_next(self):
+        if self.is_large():
+            if self.viewer.regex is None:
+                self.on_find()
+            else:
+                self.viewer.find_next()
+                self.statusBar().showMessage('Searching...')
+            return
+        if self.search is None:
+            self.on_find()
+            return
+        if not self.match_starts:
+            self.refresh_matches()
+        if not self.match_starts:
+            self.statusBar().showMessage('0 matches')
+            return
+
+        # Select the first match after the cursor, wrapping at the end.
+        cursor = self.textedit.textCursor()
+        i = bisect.bisect_left(self.match_starts, cursor.selectionEnd())
+        i %= len(self.match_starts)
+        cursor.setPosition(self.match_starts[i])
+        cursor.setPosition(self.match_ends[i], QTextCursor.KeepAnchor)
+        self.textedit.setTextCursor(cursor)
+        self.statusBar().showMessage(
+            f'Match {i + 1} of {len(self.match_starts)}')
 
-            while(self.textedit.find(token)):
+    def on_large_found(self, line):
+        if line < 0:
+            self.statusBar().showMessage('0 matches')
+        else:
+            self.statusBar().showMessage(f'Match on line {line + 1}')
+
+    def on_goto_line(self):
+        if self.is_large():
+            count = self.viewer.line_count()
+        else:
+            count = self.textedit.document().blockCount()
+        line, ok = QInputDialog.getInt(
+            self, 'Go to Line', 'Line:', 1, 1, max(1, count))
+        if not ok:
+            return
+
+        if self.is_large():
+            self.viewer.goto_line(line - 1)
+        else:
+            block = self.textedit.document().findBlockByNumber(line - 1)
+            self.textedit.setTextCursor(QTextCursor(block))
+            self.textedit.ensureCursorVisible()
+
+    def refresh_matches(self):
+        pattern, literals = self.search
+        if self.index is not None:
+            spans = self.index.spans(pattern, literals)
+        else:
+            spans = find_spans(
+                pattern, document_text(self.textedit.document()))
+        self.match_starts, self.match_ends = spans
+
+    def on_refresh_matches(self):
+        self.refresh_matches()
+        count = len(self.match_starts)
+        self.statusBar().showMessage(
+            f'{count} match{"es" if count != 1 else ""}')
+        self.update_highlights()
+
+    def on_index(self, checked):
+        document = self.textedit.document()
+        if checked and document.characterCount() > SearchIndex.MAX_CHARS:
+            # Too large from the start; the index would give up at once.
+            self.on_index_overflowed()
+        elif checked:
+            self.index = SearchIndex(document, parent=self)
+            self.index.overflowed.connect(self.on_index_overflowed)
+        elif self.index is not None:
+            self.index.dispose()
+            self.index = None
+
+    def on_index_overflowed(self):
+        self.index_action.setChecked(False)
+        self.statusBar().showMessage(
+            'Search index off: the document is too large to index')
+
+    def update_highlights(self):
+        """Marks the matches in view, with one setExtraSelections call."""
+        selections = []
+        if self.match_starts:
+            # Hit test inside the document margin; outside it, Qt answers
+            # with wherever its background layout has got to.
+            document = self.textedit.document()
+            margin = int(document.documentMargin())
+            viewport = self.textedit.viewport()
+            first = self.textedit.cursorForPosition(
+                QPoint(margin, margin)).position()
+            last = self.textedit.cursorForPosition(
+                QPoint(viewport.width(), viewport.height())).position()
+            color = QColor(Qt.yellow)
+            for i in range(bisect.bisect_right(self.match_ends, first),
+                           bisect.bisect_right(self.match_starts, last)):
                 selection = QTextEdit.ExtraSelection()
                 selection.format.setBackground(color)
-                selection.cursor = self.textedit.textCursor()
-                extra_selections.append(selection)
+                selection.cursor = QTextCursor(document)
+                selection.cursor.setPosition(self.match_starts[i])
+                selection.cursor.setPosition(
+                    self.match_ends[i], QTextCursor.KeepAnchor)
+                selections.append(selection)
+        self.textedit.setExtraSelections(selections)
+
+    def on_text_change(self, position, removed, added):
+        # Edits shift match positions; drop them rather than mark stale text.
+        if self.match_starts and (removed or added):
+            self.match_starts, self.match_ends = [], []
+            self.textedit.setExtraSelections([])
+        if self.index is not None and self.search is not None:
+            self.refresh_timer.start()
+        if self.changes is not None:
+            self.changes.on_contents_change(position, removed, added)
 
-            for i in extra_selections:
-                self.textedit.setExtraSelections(extra_selections)
+    def resizeEvent(self, event):
+        super(Window, self).resizeEvent(event)
+        self.update_highlights()
+
+    def closeEvent(self, event):
+        # The reader blocks until the next chunk is asked for; release it.
+        if self.loader is not None:
+            self.loader.cancel()
+        self.viewer.close_file()
+        self.saver.wait()
+        super(Window, self).closeEvent(event)
+
+    def is_large(self):
+        return self.stack.currentWidget() is self.viewer
+
+    def show_editor(self):
+        self.viewer.close_file()
+        self.stack.setCurrentWidget(self.textedit)
+        self.save_action.setEnabled(True)
 
     def on_new(self):
         choice = QMessageBox.question(self, 'New File', 'Clear all text?',
             QMessageBox.Yes | QMessageBox.No, QMessageBox.Yes)
         if choice == QMessageBox.Yes:
+            if self.loader is not None:
+                self.loader.cancel()
+                self.finish_open()
+            self.show_editor()
+            self.set_file(None)
             self.textedit.clear()
 
     def on_open(self):
@@ -142,26 +394,686 @@ class Window(QMainWindow):
             'Text Files (*.txt);;HTML Files (*.html)')
 
         if fname:
-            with open(fname, 'r') as f:
-                self.textedit.setText(f.read())
+            self.open_file(fname)
         else:
             QMessageBox.warning(
                 self, 'Warning', 'Unable to open file!', QMessageBox.Ok)
 
+    def open_file(self, fname):
+        """Loads fname in chunks; the window stays live meanwhile."""
+        if self.loader is not None:
+            self.loader.cancel()
+            self.finish_open()
+        self.set_file(None)
+
+        # HTML can only be parsed whole; anything else is plain text.
+        html = fname.lower().endswith('.html')
+        try:
+            large = not html and os.path.getsize(fname) >= self.LARGE_FILE_SIZE
+        except OSError:
+            large = False  # The loader reports it.
+        if large:
+            self.open_large(fname)
+            return
+
+        self.show_editor()
+        self.html_parts = [] if html else None
+        self.textedit.clear()
+        self.textedit.setReadOnly(True)
+        # Undo would keep a second copy of the whole file.
+        self.textedit.document().setUndoRedoEnabled(False)
+        self.open_cursor = QTextCursor(self.textedit.document())
+        # Saving a half-loaded document would truncate the file.
+        self.save_action.setEnabled(False)
+
+        self.loader = FileLoader(fname, self)
+        self.loader.chunk.connect(self.on_open_chunk)
+        self.loader.finished.connect(self.on_opened)
+        self.loader.error.connect(self.on_open_error)
+        self.statusBar().showMessage(f'Opening {fname}...')
+        self.progress_bar.setValue(0)
+        self.progress_bar.setVisible(True)
+        self.cancel_button.setVisible(True)
+        self.loader.start()
+
+    def open_large(self, fname):
+        """Maps fname into the large-file view instead of loading it."""
+        try:
+            self.viewer.open(fname)
+        except (OSError, ValueError) as e:
+            QMessageBox.warning(self, 'Warning', str(e), QMessageBox.Ok)
+            return
+
+        self.textedit.clear()
+        self.stack.setCurrentWidget(self.viewer)
+        # The view is read-only; there is nothing in the editor to save.
+        self.save_action.setEnabled(False)
+        self.statusBar().showMessage(f'Indexing {fname}...')
+        self.progress_bar.setValue(0)
+        self.progress_bar.setVisible(True)
+
+    def on_indexed(self, progress):
+        self.progress_bar.setValue(round(progress * 100))
+        if progress >= 1:
+            self.progress_bar.setVisible(False)
+            self.statusBar().showMessage(
+                f'{self.viewer.line_count()} lines', 5000)
+
+    def on_open_chunk(self, text, progress):
+        # Drop chunks still queued from a cancelled load.
+        if self.sender() is not self.loader:
+            return
+        if self.html_parts is not None:
+            self.html_parts.append(text)
+        else:
+            self.open_cursor.insertText(text)
+        self.progress_bar.setValue(round(progress * 100))
+        self.loader.next()
+
+    def on_opened(self):
+        if self.sender() is not self.loader:
+            return
+        fname = self.loader.fname
+        if self.html_parts is not None:
+            self.textedit.setHtml(''.join(self.html_parts))
+        self.finish_open()
+        self.statusBar().showMessage('Opened', 5000)
+        self.set_file(fname)
+        if self.changes is not None and os.path.exists(journal_name(fname)):
+            self.recover(fname)
+
+    def recover(self, fname):
+        """Offers to replay the autosave journal of fname."""
+        runs = read_journal(fname)
+        if runs is not None:
+            choice = QMessageBox.question(
+                self, 'Recover', 'Recover unsaved changes to this file?',
+                QMessageBox.Yes | QMessageBox.No, QMessageBox.Yes)
+        if runs is None or choice != QMessageBox.Yes:
+            os.remove(journal_name(fname))
+            return
+
+        document = self.textedit.document()
+        self.textedit.setPlainText(
+            replay_journal(document.toPlainText(), runs))
+        # Keep journalling against the file on disk, not the recovered text.
+        self.changes = ChangedBlocks(document)
+        self.changes.runs = [
+            [-1, run.count('\n') + 1] if isinstance(run, str) else run
+            for run in runs]
+        self.statusBar().showMessage('Recovered unsaved changes', 5000)
+
+    def on_open_error(self, message):
+        if self.sender() is not self.loader:
+            return
+        self.finish_open()
+        QMessageBox.warning(self, 'Warning', message, QMessageBox.Ok)
+
+    def on_cancel(self):
+        if self.loader is not None:
+            self.loader.cancel()
+            self.finish_open()
+            self.statusBar().showMessage('Cancelled', 5000)
+
+    def finish_open(self):
+        self.loader.deleteLater()
+        self.loader = None
+        self.html_parts = None
+        self.open_cursor = None
+        self.textedit.document().setUndoRedoEnabled(True)
+        self.textedit.setReadOnly(False)
+        self.save_action.setEnabled(True)
+        self.progress_bar.setVisible(False)
+        self.cancel_button.setVisible(False)
+
     def on_save(self):
         fname, _ = QFileDialog.getSaveFileName(
             self, 'Save File', './resources',
-            'Text Files (*.txt);;HTML Files (*.html')
+            'Text Files (*.txt);;HTML Files (*.html)')
 
         if fname.endswith('.txt'):
-            with open(fname, 'w') as f:
-                f.write(self.textedit.toPlainText())
+            text = self.textedit.toPlainText()
         elif fname.endswith('.html'):
-            with open(fname, 'w') as f:
-                f.write(self.textedit.toHtml())
+            # Qt can only serialize rich text here; it is encoded and
+            # written on the worker.
+            text = self.textedit.toHtml()
         else:
             QMessageBox.warning(
                 self, 'Warning', 'Unable to save file!', QMessageBox.Ok)
+            return
+
+        # The journals of the old and new names only hold unsaved edits.
+        stale = {journal_name(fname)}
+        if self.fname is not None:
+            stale.add(journal_name(self.fname))
+        self.saver.save(fname, text, stale)
+        self.set_file(fname)
+        self.statusBar().showMessage(f'Saving {fname}...')
+
+    def set_file(self, fname):
+        """Makes fname, as now on disk, the base for autosave journals."""
+        self.fname = fname
+        self.journal_revision = self.textedit.document().revision()
+        if fname is not None and fname.lower().endswith('.txt'):
+            self.changes = ChangedBlocks(self.textedit.document())
+        else:
+            self.changes = None
+
+    def on_saved(self, fname):
+        self.statusBar().showMessage(f'Saved {fname}', 5000)
+
+    def on_save_failed(self, message):
+        # What is on disk is unknown now; stop journalling against it.
+        self.changes = None
+        self.statusBar().clearMessage()
+        QMessageBox.warning(self, 'Warning', message, QMessageBox.Ok)
+
+    def on_autosave_toggled(self, checked):
+        if checked:
+            self.autosave_timer.start()
+        else:
+            self.autosave_timer.stop()
+
+    def on_autosave(self):
+        document = self.textedit.document()
+        if (self.changes is None or self.loader is not None
+                or document.revision() == self.journal_revision):
+            return
+        self.journal_revision = document.revision()
+        self.saver.journal(self.fname, self.changes.runs_for_journal())
+
+    def on_journaled(self, fname):
+        self.statusBar().showMessage('Autosaved', 2000)
+
+
+class FindDialog(QDialog):
+    def __init__(self, parent=None):
+        super(FindDialog, self).__init__(parent)
+        self.setWindowTitle('Find Text')
+        self.add_widgets()
+
+    def add_widgets(self):
+        form_layout = QFormLayout()
+        form_layout.setContentsMargins(8, 8, 8, 8)
+        self.setLayout(form_layout)
+
+        # Add search text edit.
+        self.text_edit = QLineEdit()
+        form_layout.addRow('Find:', self.text_edit)
+
+        # Add search option checkboxes.
+        self.case_checkbox = QCheckBox('Match case')
+        form_layout.addRow(self.case_checkbox)
+        self.words_checkbox = QCheckBox('Match any of the words')
+        form_layout.addRow(self.words_checkbox)
+        self.regex_checkbox = QCheckBox('Regular expression')
+        form_layout.addRow(self.regex_checkbox)
+
+        buttons = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel)
+        buttons.accepted.connect(self.accept)
+        buttons.rejected.connect(self.reject)
+        form_layout.addRow(buttons)
+
+    def text(self):
+        return self.text_edit.text()
+
+    def literals(self):
+        """Returns the literal strings searched for, or None for a regex."""
+        if self.regex_checkbox.isChecked():
+            return None
+        if self.words_checkbox.isChecked():
+            return self.text().split()
+        return [self.text()]
+
+    def pattern(self):
+        """Compiles the search; raises re.error for a bad expression."""
+        text = self.text()
+        if not self.regex_checkbox.isChecked():
+            # Longest first, so a word wins over its own prefix.
+            words = sorted(set(self.literals()), key=len, reverse=True)
+            text = '|'.join(map(re.escape, words))
+        flags = 0 if self.case_checkbox.isChecked() else re.IGNORECASE
+        return re.compile(text, flags)
+
+
+class SearchIndex(QObject):
+    """Trigram index over a QTextDocument, kept current on a worker thread.
+
+    The document is mirrored as pages of about PAGE_SIZE characters, and
+    each trigram of the lower-cased text maps to a bit mask of the pages
+    holding it. A literal search then scans only the pages that contain
+    every trigram of one of its literals, and reuses the last search's
+    matches on pages that have not changed since; a regex search scans
+    the whole document.
+
+    Edits arrive as block deltas from contentsChange and are applied on a
+    private thread pool. spans() applies any deltas still queued first,
+    so it always sees the current text. Past max_chars the index gives up
+    and emits overflowed; dispose() frees it.
+    """
+
+    PAGE_SIZE = 1 << 14
+    MAX_CHARS = 32 << 20
+
+    overflowed = pyqtSignal()
+
+    def __init__(self, document, max_chars=MAX_CHARS, parent=None):
+        super(SearchIndex, self).__init__(parent)
+        self.document = document
+        self.max_chars = max_chars
+        self.lock = threading.Lock()
+        self.deltas = queue.SimpleQueue()
+        self.pages = []
+        self.masks = {}
+        self.free_ids = []
+        self.next_id = 0
+        self.cache_key = None
+        self.cache = {}
+
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(1)
+        self.task = Task(self.drain)
+        self.block_count = 0
+        document.contentsChange.connect(self.on_contents_change)
+        self.on_contents_change(0, 0, document.characterCount())
+
+    def dispose(self):
+        if self.document is None:
+            return
+        self.document.contentsChange.disconnect(self.on_contents_change)
+        self.document = None
+        self.pool.clear()
+        self.pool.waitForDone()
+        with self.lock:
+            self.pages, self.masks, self.cache = [], {}, {}
+            self.free_ids, self.next_id = [], 0
+            self.deltas = queue.SimpleQueue()
+
+    def on_contents_change(self, position, removed, added):
+        document = self.document
+        if document.characterCount() > self.max_chars:
+            self.dispose()
+            self.overflowed.emit()
+            return
+
+        first, count, replaced = edited_blocks(
+            document, position, added, self.block_count)
+        self.block_count = document.blockCount()
+
+        lines = []
+        block = first
+        for _ in range(count):
+            lines.append(block.text())
+            block = block.next()
+        self.deltas.put((first.blockNumber(), replaced, lines))
+        self.pool.start(self.task)
+
+    def drain(self):
+        with self.lock:
+            while True:
+                try:
+                    delta = self.deltas.get_nowait()
+                except queue.Empty:
+                    return
+                self.apply(*delta)
+
+    def apply(self, start, replaced, lines):
+        # Find the pages holding lines start .. start + replaced - 1.
+        first, line = 0, 0
+        while (first < len(self.pages) - 1
+               and line + self.pages[first].count <= start):
+            line += self.pages[first].count
+            first += 1
+        last, end = first, line + (
+            self.pages[first].count if self.pages else 0)
+        while last < len(self.pages) - 1 and end < start + replaced:
+            last += 1
+            end += self.pages[last].count
+
+        old = self.pages[first:last + 1]
+        merged = []
+        if old:
+            merged = '\n'.join(page.text for page in old).split('\n')
+        merged[start - line:start - line + replaced] = lines
+        for page in old:
+            self.unindex(page)
+        new = self.paginate(merged)
+        for page in new:
+            self.index(page)
+        self.pages[first:last + 1] = new
+
+    def paginate(self, lines):
+        pages, chunk, size = [], [], 0
+        for line in lines:
+            chunk.append(line)
+            size += len(line) + 1
+            if size >= self.PAGE_SIZE:
+                pages.append(IndexPage(self.new_id(), chunk))
+                chunk, size = [], 0
+        if chunk or not pages:
+            pages.append(IndexPage(self.new_id(), chunk))
+        return pages
+
+    def new_id(self):
+        if self.free_ids:
+            return self.free_ids.pop()
+        self.next_id += 1
+        return self.next_id - 1
+
+    def index(self, page):
+        bit = 1 << page.id
+        for trigram in trigrams(page.text):
+            self.masks[trigram] = self.masks.get(trigram, 0) | bit
+
+    def unindex(self, page):
+        bit = 1 << page.id
+        for trigram in trigrams(page.text):
+            mask = self.masks[trigram] & ~bit
+            if mask:
+                self.masks[trigram] = mask
+            else:
+                del self.masks[trigram]
+        self.cache.pop(page.id, None)
+        self.free_ids.append(page.id)
+
+    def candidates(self, literals):
+        """Returns a bit mask of the pages that may hold a match."""
+        mask = 0
+        for literal in literals:
+            keys = trigrams(literal)
+            if not keys:
+                return -1
+            found = -1
+            for key in keys:
+                found &= self.masks.get(key, 0)
+            mask |= found
+        return mask
+
+    def spans(self, pattern, literals):
+        """Returns start and end document positions of all matches."""
+        if literals is None or any('\n' in literal for literal in literals):
+            # A regex may anchor at or match across page boundaries, so
+            # only literals confined to one line can be matched per page.
+            return find_spans(pattern, document_text(self.document))
+        self.drain()
+        with self.lock:
+            key = pattern.pattern, pattern.flags
+            if key != self.cache_key:
+                self.cache_key, self.cache = key, {}
+            mask = self.candidates(literals)
+            starts, ends = [], []
+            offset = 0
+            for page in self.pages:
+                if mask >> page.id & 1:
+                    if page.id not in self.cache:
+                        self.cache[page.id] = find_spans(pattern, page.text)
+                    page_starts, page_ends = self.cache[page.id]
+                    starts.extend(offset + i for i in page_starts)
+                    ends.extend(offset + i for i in page_ends)
+                offset += page.size
+            return starts, ends
+
+
+class IndexPage:
+    """A run of whole blocks of a SearchIndex."""
+
+    __slots__ = ('id', 'text', 'count', 'size')
+
+    def __init__(self, id, lines):
+        self.id = id
+        self.text = '\n'.join(lines)
+        self.count = len(lines)
+        # Document positions: UTF-16 units plus one separator per block.
+        self.size = len(self.text) + 1 + len(ASTRAL.findall(self.text))
+
+
+class DocumentSaver(QObject):
+    """Writes files and autosave journals on a worker thread.
+
+    Jobs run one at a time in the order they were queued, so a journal
+    record never lands before the save it builds on.
+    """
+
+    saved = pyqtSignal(str)
+    journaled = pyqtSignal(str)
+    failed = pyqtSignal(str)
+
+    def __init__(self, parent=None):
+        super(DocumentSaver, self).__init__(parent)
+        self.jobs = queue.SimpleQueue()
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(1)
+        self.task = Task(self.drain)
+
+    def save(self, fname, text, stale=()):
+        """Writes text to fname and drops the journals in stale."""
+        self.jobs.put((self.write, (fname, text, stale)))
+        self.pool.start(self.task)
+
+    def journal(self, fname, runs):
+        """Replaces the journal of fname with runs from ChangedBlocks."""
+        self.jobs.put((self.write_journal, (fname, runs)))
+        self.pool.start(self.task)
+
+    def wait(self):
+        self.pool.waitForDone()
+
+    def drain(self):
+        while True:
+            try:
+                fn, args = self.jobs.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                fn(*args)
+            except (OSError, ValueError) as e:
+                # ValueError covers text that will not encode, such as
+                # a lone surrogate.
+                self.failed.emit(str(e))
+
+    def write(self, fname, text, stale):
+        replace_file(fname, text.encode('utf-8'))
+
+        # The journals only held what is now on disk.
+        for name in stale:
+            if os.path.exists(name):
+                os.remove(name)
+        self.saved.emit(fname)
+
+    def write_journal(self, fname, runs):
+        # Each record holds every block edited since the save, so only
+        # the latest is kept. Stamp it with the file it applies to, so a
+        # journal is not replayed over a file changed by someone else.
+        stat = os.stat(fname)
+        record = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                  'runs': runs}
+        replace_file(journal_name(fname), json.dumps(record).encode('utf-8'),
+                     private=True)
+        self.journaled.emit(fname)
+
+
+class ChangedBlocks:
+    """Tracks which blocks of a document changed since it was saved.
+
+    The document is kept as runs: [start, count] is count lines of the
+    saved file from start, and [-1, count] is count edited blocks. Runs
+    only split where edits land, so there are about as many as edits and
+    a journal record is about as big as the changes.
+    """
+
+    def __init__(self, document):
+        self.document = document
+        self.block_count = document.blockCount()
+        self.runs = [[0, self.block_count]]
+
+    def on_contents_change(self, position, removed, added):
+        first, count, replaced = edited_blocks(
+            self.document, position, added, self.block_count)
+        self.block_count = self.document.blockCount()
+        self.splice(first.blockNumber(), replaced, count)
+
+    def splice(self, start, replaced, count):
+        """Replaces replaced blocks from start with count edited ones."""
+        stop = start + replaced
+        before, after = [], []
+        line = 0
+        for base, size in self.runs:
+            if line < start:
+                before.append([base, min(size, start - line)])
+            if line + size > stop:
+                skip = max(0, stop - line)
+                after.append([base + skip if base >= 0 else -1, size - skip])
+            line += size
+
+        # Merge neighbours: edited runs, and copies of adjacent lines.
+        runs = []
+        for run in before + [[-1, count]] + after:
+            if run[1] == 0:
+                continue
+            if runs and (runs[-1][0] < 0 and run[0] < 0
+                         or runs[-1][0] >= 0
+                         and runs[-1][0] + runs[-1][1] == run[0]):
+                runs[-1][1] += run[1]
+            else:
+                runs.append(run)
+        self.runs = runs
+
+    def runs_for_journal(self):
+        """Returns the runs with the text of the edited blocks filled in."""
+        runs = []
+        line = 0
+        for base, size in self.runs:
+            if base < 0:
+                block = self.document.findBlockByNumber(line)
+                lines = []
+                for _ in range(size):
+                    lines.append(block.text())
+                    block = block.next()
+                runs.append('\n'.join(lines))
+            else:
+                runs.append([base, size])
+            line += size
+        return runs
+
+
+def trigrams(text):
+    text = text.lower()
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+ASTRAL = re.compile('[\U00010000-\U0010ffff]')
+
+
+def document_text(document):
+    """Returns the text of document, indexed like document positions."""
+    # Unlike toPlainText, raw text keeps frame markers, so offsets match.
+    text = document.toRawText()
+    return text.replace('\u2029', '\n').replace('\u2028', '\n')
+
+
+def edited_blocks(document, position, added, block_count):
+    """Maps a contentsChange to the blocks it rewrote.
+
+    Returns the first block the edit touched, the number of blocks it now
+    spans, and how many of the block_count blocks from before the edit
+    those replace, which the net change in block count tells.
+    """
+    first = document.findBlock(position)
+    last = document.findBlock(position + added)
+    if not last.isValid():
+        last = document.lastBlock()
+    count = last.blockNumber() - first.blockNumber() + 1
+    return first, count, count - (document.blockCount() - block_count)
+
+
+def find_spans(pattern, text):
+    """Returns start and end document positions of all matches.
+
+    The text is scanned once, by the regex engine. Python indexes code
+    points while Qt counts UTF-16 units, so positions after characters
+    outside the BMP are shifted to match.
+    """
+    spans = [match.span() for match in pattern.finditer(text)]
+    starts = [start for start, end in spans if start != end]
+    ends = [end for start, end in spans if start != end]
+    astral = [match.start() for match in ASTRAL.finditer(text)]
+    if astral:
+        starts = [i + bisect.bisect_left(astral, i) for i in starts]
+        ends = [i + bisect.bisect_left(astral, i) for i in ends]
+    return starts, ends
+
+
+def replace_file(fname, data, private=False):
+    """Writes data to fname atomically and durably.
+
+    The data goes to a temporary file next to fname, which is flushed to
+    disk and renamed over fname; the directory is then flushed too, so
+    the rename survives a crash. A private file stays readable by the
+    owner only.
+    """
+    directory = os.path.dirname(os.path.abspath(fname))
+    fd, tmp_name = tempfile.mkstemp(suffix='.tmp', prefix='.', dir=directory)
+    try:
+        with open(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        if not private:
+            keep_mode(fname, tmp_name)
+        os.replace(tmp_name, fname)
+    except BaseException:
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+        raise
+
+    # Directories cannot be opened for syncing on Windows.
+    if hasattr(os, 'O_DIRECTORY'):
+        fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def journal_name(fname):
+    """Returns the autosave journal kept next to fname."""
+    directory, name = os.path.split(os.path.abspath(fname))
+    return os.path.join(directory, f'.{name}.journal')
+
+
+def read_journal(fname):
+    """Returns the runs recorded in the journal of fname.
+
+    Returns None if there is no readable journal, or if fname has changed
+    since the record was written.
+    """
+    try:
+        with open(journal_name(fname), encoding='utf-8') as f:
+            record = json.load(f)
+        stat = os.stat(fname)
+    except (OSError, ValueError):
+        return None
+    if (record['size'], record['mtime_ns']) != (
+            stat.st_size, stat.st_mtime_ns):
+        return None
+    return record['runs']
+
+
+def replay_journal(text, runs):
+    """Rebuilds a document from its saved text and journal runs."""
+    lines = text.split('\n')
+    return '\n'.join(
+        run if isinstance(run, str)
+        else '\n'.join(lines[run[0]:run[0] + run[1]]) for run in runs)
+
+
+def bytes_pattern(pattern):
+    """Recompiles a str pattern to search UTF-8 bytes.
+
+    Character classes such as \\w and ignoring case only cover ASCII then.
+    """
+    return re.compile(
+        pattern.pattern.encode('utf-8'), pattern.flags & ~re.UNICODE)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,412 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""--- textfile.py ---
+
+Text file loading, large-file viewing and safe saving shared by the samples.
+
+@author   hank.aetos@gmail.com
+@version  0.1.0
+@license  MIT
+
+--- Copyright (C) 2020 Hank Aetos ---
+"""
+
+
+import array
+import bisect
+import mmap
+import os
+import shutil
+import stat
+import threading
+
+from PyQt5.QtWidgets import QAbstractScrollArea, QAbstractSlider
+from PyQt5.QtGui import QColor, QPainter, QFontDatabase
+from PyQt5.QtCore import Qt, QObject, QRunnable, QThreadPool, pyqtSignal
+
+
+class FileLoader(QObject):
+    """Reads a text file on a worker thread and hands it out in chunks.
+
+    Only a few chunks are in flight at a time: the reader waits for the
+    receiver to call next() before it reads on, so memory stays flat
+    however large the file.
+    """
+
+    CHUNK_SIZE = 1 << 16
+    IN_FLIGHT = 4
+
+    chunk = pyqtSignal(str, float)
+    finished = pyqtSignal()
+    error = pyqtSignal(str)
+
+    def __init__(self, fname, parent=None):
+        super(FileLoader, self).__init__(parent)
+        self.fname = fname
+        self.cancelled = False
+        self.credits = threading.Semaphore(self.IN_FLIGHT)
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(1)
+        self.task = Task(self.read)
+
+    def start(self):
+        self.pool.start(self.task)
+
+    def next(self):
+        self.credits.release()
+
+    def cancel(self):
+        self.cancelled = True
+        self.credits.release()
+        self.pool.waitForDone()
+
+    def read(self):
+        try:
+            size = os.path.getsize(self.fname) or 1
+            with open(self.fname, encoding='utf-8', errors='replace') as f:
+                while True:
+                    text = f.read(self.CHUNK_SIZE)
+                    if not text:
+                        break
+                    self.credits.acquire()
+                    if self.cancelled:
+                        return
+                    self.chunk.emit(text, f.buffer.tell() / size)
+        except OSError as e:
+            self.error.emit(str(e))
+        else:
+            self.finished.emit()
+
+
+class LargeFileView(QAbstractScrollArea):
+    """Read-only view of a MappedFile that lays out only the lines in view.
+
+    Lines are decoded as they are painted, so memory does not grow with the
+    file; very long lines are cut at MAX_LINE bytes.
+    """
+
+    MAX_LINE = 1 << 12
+
+    indexed = pyqtSignal(float)
+    found = pyqtSignal(int)
+
+    def __init__(self, parent=None):
+        super(LargeFileView, self).__init__(parent)
+        self.file = None
+        self.regex = None
+        self.match = None
+        self.current_line = None
+        self.text_width = 0
+        self.setFont(QFontDatabase.systemFont(QFontDatabase.FixedFont))
+        self.verticalScrollBar().valueChanged.connect(self.viewport().update)
+        self.horizontalScrollBar().valueChanged.connect(
+            self.viewport().update)
+
+    def open(self, fname):
+        """Maps fname; raises OSError or ValueError if it cannot be mapped."""
+        self.close_file()
+        self.file = MappedFile(fname, self)
+        self.file.indexed.connect(self.on_indexed)
+        self.file.found.connect(self.on_found)
+        self.verticalScrollBar().setValue(0)
+        self.horizontalScrollBar().setValue(0)
+        self.update_scrollbars()
+        self.file.start()
+
+    def close_file(self):
+        if self.file is not None:
+            self.file.close()
+            self.file.deleteLater()
+            self.file = None
+        self.regex = None
+        self.match = None
+        self.current_line = None
+        self.text_width = 0
+        self.update_scrollbars()
+        self.viewport().update()
+
+    def line_count(self):
+        return self.file.line_count() if self.file is not None else 0
+
+    def visible_lines(self):
+        return max(1, self.viewport().height() // self.fontMetrics().height())
+
+    def update_scrollbars(self):
+        visible = self.visible_lines()
+        bar = self.verticalScrollBar()
+        bar.setPageStep(visible)
+        bar.setRange(0, max(0, self.line_count() - visible))
+        width = self.viewport().width()
+        bar = self.horizontalScrollBar()
+        bar.setPageStep(width)
+        bar.setRange(0, max(0, self.text_width - width))
+
+    def line_text(self, start, end):
+        data = self.file.map[start:min(end, start + self.MAX_LINE)]
+        return data.decode('utf-8', 'replace').rstrip('\r').expandtabs()
+
+    def goto_line(self, line):
+        """Scrolls line (counted from 0) to the middle of the view."""
+        self.current_line = line
+        self.verticalScrollBar().setValue(line - self.visible_lines() // 2)
+        self.horizontalScrollBar().setValue(0)
+        self.viewport().update()
+
+    def find(self, regex):
+        """Searches from the top of the view for a bytes regex."""
+        self.regex = regex
+        self.match = None
+        self.file.find(
+            regex, self.file.line_start(self.verticalScrollBar().value()))
+
+    def find_next(self):
+        if self.match is None:
+            self.find(self.regex)
+        else:
+            self.file.find(self.regex, self.match[1])
+
+    def on_indexed(self, progress):
+        if self.sender() is not self.file:
+            return
+        self.update_scrollbars()
+        self.indexed.emit(progress)
+
+    def on_found(self, start, end):
+        if self.sender() is not self.file:
+            return
+        if start < 0:
+            self.match = None
+            self.viewport().update()
+            self.found.emit(-1)
+            return
+
+        self.match = start, end
+        line = self.file.line_of(start)
+        self.goto_line(line)
+
+        # Bring the match into view sideways too.
+        line_start = self.file.line_start(line)
+        metrics = self.fontMetrics()
+        left = metrics.horizontalAdvance(self.line_text(line_start, start))
+        bar = self.horizontalScrollBar()
+        if not bar.value() <= left < bar.value() + bar.pageStep():
+            self.text_width = max(self.text_width, left + bar.pageStep())
+            self.update_scrollbars()
+            bar.setValue(left - bar.pageStep() // 2)
+        self.found.emit(line)
+
+    def keyPressEvent(self, event):
+        actions = {
+            Qt.Key_Up: QAbstractSlider.SliderSingleStepSub,
+            Qt.Key_Down: QAbstractSlider.SliderSingleStepAdd,
+            Qt.Key_PageUp: QAbstractSlider.SliderPageStepSub,
+            Qt.Key_PageDown: QAbstractSlider.SliderPageStepAdd,
+            Qt.Key_Home: QAbstractSlider.SliderToMinimum,
+            Qt.Key_End: QAbstractSlider.SliderToMaximum,
+        }
+        if event.key() in actions:
+            self.verticalScrollBar().triggerAction(actions[event.key()])
+        elif event.key() == Qt.Key_Left:
+            self.horizontalScrollBar().triggerAction(
+                QAbstractSlider.SliderSingleStepSub)
+        elif event.key() == Qt.Key_Right:
+            self.horizontalScrollBar().triggerAction(
+                QAbstractSlider.SliderSingleStepAdd)
+        else:
+            super(LargeFileView, self).keyPressEvent(event)
+
+    def resizeEvent(self, event):
+        super(LargeFileView, self).resizeEvent(event)
+        self.update_scrollbars()
+
+    def paintEvent(self, event):
+        painter = QPainter(self.viewport())
+        if self.file is None:
+            return
+
+        metrics = self.fontMetrics()
+        height = metrics.height()
+        width = self.viewport().width()
+        first = self.verticalScrollBar().value()
+        x = -self.horizontalScrollBar().value()
+        text_width = self.text_width
+        lines = self.file.lines(first, self.visible_lines() + 1)
+        for row, (start, end) in enumerate(lines):
+            y = row * height
+            if first + row == self.current_line:
+                painter.fillRect(0, y, width, height, QColor(235, 235, 235))
+            if (self.match is not None
+                    and start <= self.match[0] <= start + self.MAX_LINE
+                    and self.match[0] <= end):
+                left = metrics.horizontalAdvance(
+                    self.line_text(start, self.match[0]))
+                right = metrics.horizontalAdvance(
+                    self.line_text(start, min(self.match[1], end)))
+                painter.fillRect(x + left, y, max(right - left, 2), height,
+                                 QColor(Qt.yellow))
+            text = self.line_text(start, end)
+            painter.drawText(x, y + metrics.ascent(), text)
+            text_width = max(text_width, metrics.horizontalAdvance(text))
+
+        # The widest line is only known once it has been seen.
+        if text_width > self.text_width:
+            self.text_width = text_width
+            self.update_scrollbars()
+
+
+class MappedFile(QObject):
+    """A memory-mapped file with a line index built in the background.
+
+    The index keeps the number of line breaks before every BLOCK_SIZE
+    bytes, not the offset of every line, so it stays small however many
+    lines there are; a line is found by scanning at most one block.
+    Indexing and searching share one worker and never hold the GIL for
+    more than SCAN_SIZE bytes at a time.
+    """
+
+    BLOCK_SIZE = 1 << 16
+    SCAN_SIZE = 1 << 22
+
+    indexed = pyqtSignal(float)
+    found = pyqtSignal(int, int)
+
+    def __init__(self, fname, parent=None):
+        super(MappedFile, self).__init__(parent)
+        with open(fname, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.size = len(self.map)
+        self.block_lines = array.array('q', [0])
+        self.lines_total = None
+        self.closed = False
+        self.query = None
+        self.served = None
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(1)
+        self.index_task = Task(self.build_index)
+        self.search_task = Task(self.search)
+
+    def start(self):
+        self.pool.start(self.index_task)
+
+    def close(self):
+        self.closed = True
+        self.pool.clear()
+        self.pool.waitForDone()
+        self.map.close()
+
+    def build_index(self):
+        count = 0
+        for start in range(0, self.size, self.SCAN_SIZE):
+            if self.closed:
+                return
+            data = self.map[start:start + self.SCAN_SIZE]
+            for offset in range(0, len(data), self.BLOCK_SIZE):
+                count += data.count(b'\n', offset, offset + self.BLOCK_SIZE)
+                self.block_lines.append(count)
+            if start + len(data) == self.size:
+                # A last line without a line break still counts.
+                self.lines_total = count + (data[-1:] != b'\n')
+            self.indexed.emit((start + len(data)) / self.size)
+
+    def line_count(self):
+        """Returns the number of lines, or as many as are indexed so far."""
+        if self.lines_total is not None:
+            return self.lines_total
+        return self.block_lines[-1]
+
+    def line_start(self, line):
+        """Returns the offset of line, counted from 0."""
+        if line <= 0:
+            return 0
+        # Find the block holding the line break before line, then walk it.
+        block = bisect.bisect_left(self.block_lines, line) - 1
+        start = block * self.BLOCK_SIZE
+        for _ in range(line - self.block_lines[block]):
+            start = self.map.find(b'\n', start) + 1
+            if start == 0:
+                return self.size
+        return start
+
+    def line_of(self, offset):
+        """Returns the line, counted from 0, that offset falls on."""
+        block = offset // self.BLOCK_SIZE
+        start = block * self.BLOCK_SIZE
+        return self.block_lines[block] + self.map[start:offset].count(b'\n')
+
+    def lines(self, first, count):
+        """Yields start and end offsets of up to count lines from first."""
+        start = self.line_start(first)
+        for _ in range(count):
+            if start >= self.size:
+                return
+            end = self.map.find(b'\n', start)
+            if end < 0:
+                end = self.size
+            yield start, end
+            start = end + 1
+
+    def find(self, regex, start):
+        """Looks for regex from start on, wrapping around; emits found.
+
+        The search queues behind the index, so line_of can place the match.
+        """
+        self.query = object(), regex, start
+        self.pool.start(self.search_task)
+
+    def search(self):
+        query = self.query
+        if query is self.served:
+            return
+        self.served = query
+        _, regex, start = query
+
+        # Scan windows that end on line breaks, so no match is cut in two.
+        for window_start, stop in ((start, self.size), (0, start)):
+            while window_start < stop:
+                if self.closed or self.query is not query:
+                    return
+                end = self.map.find(
+                    b'\n', min(window_start + self.SCAN_SIZE, stop))
+                end = stop if end < 0 else min(end + 1, stop)
+                for match in regex.finditer(self.map, window_start, end):
+                    if match.end() > match.start():
+                        self.found.emit(match.start(), match.end())
+                        return
+                window_start = end
+        self.found.emit(-1, -1)
+
+
+class Task(QRunnable):
+    """Runs fn on a thread pool; may be started again once done."""
+
+    def __init__(self, fn):
+        super(Task, self).__init__()
+        self.setAutoDelete(False)
+        self.fn = fn
+
+    def run(self):
+        self.fn()
+
+
+def keep_mode(fname, tmp_name):
+    """Gives tmp_name the mode of fname, or the default for a new file.
+
+    mkstemp makes files only the owner can read, and renaming the
+    temporary file over fname would carry that over. A new file gets
+    the mode a plain open() would give it, found by creating a probe
+    rather than by setting the process-wide umask.
+    """
+    try:
+        shutil.copymode(fname, tmp_name)
+        return
+    except FileNotFoundError:
+        pass
+
+    probe = tmp_name + '.mode'
+    fd = os.open(probe, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    try:
+        mode = stat.S_IMODE(os.fstat(fd).st_mode)
+    finally:
+        os.close(fd)
+        os.remove(probe)
+    os.chmod(tmp_name, mode)